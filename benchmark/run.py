@@ -0,0 +1,253 @@
+import argparse
+import json
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from os import environ, makedirs, path
+from time import perf_counter
+
+from benchmark.server import BenchmarkServer, Catalog
+
+# Offline benchmark: crawls the local stand-in server into a scratch store, then times the parsers and the export.
+# Every stage runs in its own process, so its peak RSS is its own.
+#
+#   python -m benchmark.run
+#   python -m benchmark.run --json results.json
+#   python -m benchmark.run --compare results.json    exits with 1 if a stage got slower than the tolerance
+
+repository = path.dirname(path.dirname(path.abspath(__file__)))
+
+lattice_names = (('radical', 'radicals'), ('kanji', 'kanji'), ('vocab', 'vocabulary'))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux. Children are the extraction pool, if one ran.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def stored_pages(store):
+    return [(item_type, url) for item_type, name in lattice_names for url in store.get_lattice_list(name)]
+
+
+def stage_crawl(options):
+    from urllib.parse import urlparse
+    from wanianki.importer import Importer, Store
+
+    base = options['base']
+    rate_limits = {
+        urlparse(base['api']).hostname: (options['api_rate'], options['burst']),
+        urlparse(base['site']).hostname: (options['site_rate'], options['burst']),
+    }
+
+    store = Store()
+    importer = Importer(store, 'benchmark', 'benchmark', options['concurrency'], rate_limits,
+                        backend=options['backend'], audio_concurrency=options['audio_concurrency'])
+    importer.root = base['api']
+    importer.site = base['site']
+
+    start = perf_counter()
+    importer.run()
+    seconds = perf_counter() - start
+
+    pages = len(stored_pages(store))
+    return {
+        'seconds': seconds,
+        'pages': pages,
+        'pages_per_second': pages / seconds,
+        'limiter_sleep': sum(limiter.sleeping for limiter in importer.limiters.values()),
+    }
+
+
+def stage_parse(options):
+    # Extraction alone: pages are read up front and the extraction cache is bypassed.
+    from wanianki.importer import Exporter, Store
+
+    store = Store()
+    pages = [(item_type, url, store.load_page(url[1:])) for item_type, url in stored_pages(store)]
+
+    timings = []
+    for item_type, url, html in pages:
+        start = perf_counter()
+        Exporter.extract(store, item_type, url, options['parser'], html)
+        timings.append(perf_counter() - start)
+
+    timings.sort()
+    seconds = sum(timings)
+    return {
+        'seconds': seconds,
+        'pages': len(pages),
+        'pages_per_second': len(pages) / seconds,
+        'ms_per_page': seconds * 1000 / len(pages),
+        'ms_per_page_p95': timings[int(len(timings) * 0.95)] * 1000,
+    }
+
+
+def stage_export(options):
+    # The whole export with a cold extraction cache: loading, extracting in the pool and writing the output.
+    from wanianki.importer import Exporter, Store
+
+    store = Store()
+    shutil.rmtree(store.dir('extracted'))
+    makedirs(store.dir('extracted'))
+
+    exporter = Exporter(store, options['parser'], options['workers'], output=options['output'])
+    start = perf_counter()
+    exporter.run()
+    seconds = perf_counter() - start
+
+    pages = len(stored_pages(store))
+    return {
+        'seconds': seconds,
+        'pages': pages,
+        'pages_per_second': pages / seconds,
+        'workers': exporter.workers,
+    }
+
+
+stages = {
+    'crawl': stage_crawl,
+    'parse': stage_parse,
+    'export': stage_export,
+}
+
+
+def run_stage(name, workdir, options, verbose):
+    with tempfile.NamedTemporaryFile('r', suffix='.json', dir=workdir) as result:
+        env = dict(environ, PYTHONPATH=repository + path.pathsep + environ.get('PYTHONPATH', ''))
+        subprocess.run([sys.executable, '-m', 'benchmark.run', '--stage', name, '--options', json.dumps(options),
+                        '--result', result.name],
+                       cwd=workdir, env=env, check=True, stdout=None if verbose else subprocess.DEVNULL)
+        return json.load(result)
+
+
+def report(name, result):
+    line = '{:<14} {:>5} pages {:>8.2f} s {:>9.1f} pages/s'.format(
+        name, result['pages'], result['seconds'], result['pages_per_second'])
+    if 'ms_per_page' in result:
+        line += ' {:>7.2f} ms/page (p95 {:.2f})'.format(result['ms_per_page'], result['ms_per_page_p95'])
+    if 'limiter_sleep' in result:
+        line += '   limiter sleep {:.1f} s'.format(result['limiter_sleep'])
+    line += '   peak rss {:.1f} MB'.format(result['peak_rss_mb'])
+    print(line)
+
+    for kind, stats in sorted(result.get('requests', {}).items()):
+        print('  {:<12} {:>5} requests {:>4} x 429 {:>8.1f} req/s  peak concurrency {:>3}  {:>8.1f} kB'.format(
+            kind, stats['requests'], stats['rate_limited'], stats['requests_per_second'] or 0,
+            stats['peak_concurrency'], stats['bytes'] / 1024))
+
+
+def compare(baseline, results, tolerance):
+    # Throughput may drop and time per page and memory may grow by at most `tolerance` (a fraction).
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        for metric, higher_is_better in (('pages_per_second', True), ('ms_per_page', False),
+                                         ('peak_rss_mb', False)):
+            if metric not in result or metric not in before:
+                continue
+            if higher_is_better:
+                regressed = result[metric] < before[metric] * (1 - tolerance)
+            else:
+                regressed = result[metric] > before[metric] * (1 + tolerance)
+            if regressed:
+                regressions.append((name, metric, before[metric], result[metric]))
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the crawl, the parsers and the export.')
+    parser.add_argument('--levels', type=int, default=10, help='levels of generated subjects')
+    parser.add_argument('--radicals', type=int, default=8, help='radicals per level')
+    parser.add_argument('--kanji', type=int, default=12, help='kanji per level')
+    parser.add_argument('--vocabulary', type=int, default=20, help='vocabulary per level')
+    parser.add_argument('--latency', type=float, default=0.01, help='server latency per request, in seconds')
+    parser.add_argument('--per-page', type=int, default=100, help='subjects per api page')
+    parser.add_argument('--server-api-rate', type=float, default=20, help='api requests per second before 429s')
+    parser.add_argument('--server-site-rate', type=float, default=200, help='site requests per second before 429s')
+    parser.add_argument('--server-burst', type=int, default=10)
+    parser.add_argument('--api-rate', type=float, default=25, help='the importer\'s api rate limit')
+    parser.add_argument('--site-rate', type=float, default=250, help='the importer\'s site rate limit')
+    parser.add_argument('--burst', type=int, default=10, help='the importer\'s burst size')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--audio-concurrency', type=int, default=8)
+    parser.add_argument('--backend', default='threads', help='threads or aiohttp')
+    parser.add_argument('--parsers', default='bs4,lxml', help='parsers to time, comma separated')
+    parser.add_argument('--workers', type=int, default=None, help='extraction processes for the export')
+    parser.add_argument('--output', default='csv', help='csv or apkg')
+    parser.add_argument('--workdir', help='keep the scratch store here instead of a temporary directory')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression, as a fraction')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the stages')
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        result = stages[args.stage](json.loads(args.options))
+        result['peak_rss_mb'] = peak_rss_mb()
+        with open(args.result, 'w') as f:
+            json.dump(result, f)
+        return
+
+    catalog = Catalog(args.levels, args.radicals, args.kanji, args.vocabulary)
+    server = BenchmarkServer(catalog, {
+        'api': (args.server_api_rate, args.server_burst),
+        'site': (args.server_site_rate, args.server_burst),
+    }, args.latency, args.per_page).start()
+
+    scratch = None
+    workdir = args.workdir
+    if not workdir:
+        scratch = tempfile.TemporaryDirectory()
+        workdir = scratch.name
+    makedirs(workdir, exist_ok=True)
+
+    results = {}
+    try:
+        server.stats.reset()
+        results['crawl'] = run_stage('crawl', workdir, {
+            'base': server.base, 'api_rate': args.api_rate, 'site_rate': args.site_rate, 'burst': args.burst,
+            'concurrency': args.concurrency, 'audio_concurrency': args.audio_concurrency, 'backend': args.backend,
+        }, args.verbose)
+        results['crawl']['requests'] = server.stats.snapshot()
+        report('crawl', results['crawl'])
+
+        for page_parser in args.parsers.split(','):
+            name = 'parse-' + page_parser
+            results[name] = run_stage('parse', workdir, {'parser': page_parser}, args.verbose)
+            report(name, results[name])
+
+        for page_parser in args.parsers.split(','):
+            name = 'export-' + page_parser
+            results[name] = run_stage('export', workdir, {
+                'parser': page_parser, 'workers': args.workers, 'output': args.output,
+            }, args.verbose)
+            report(name, results[name])
+    finally:
+        server.stop()
+        if scratch:
+            scratch.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for name, metric, before, after in regressions:
+            print('[regression] {} {}: {:.2f} -> {:.2f}'.format(name, metric, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+from socketserver import ThreadingMixIn
+from string import Template
+from time import sleep, time
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+# Local stand-in for api.wanikani.com, www.wanikani.com and the audio cdn, serving generated subjects rendered
+# from the fixtures. Only what the importer uses: /v2/subjects with pages.next_url paging and the levels/types/
+# updated_after filters, subject pages, radical svgs and mp3s.
+
+fixtures = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name, mode='r'):
+    with open(path.join(fixtures, name), mode) as f:
+        return f.read()
+
+
+class Catalog:
+    # The generated subjects: `radicals`, `kanji` and `vocabulary` per level.
+    def __init__(self, levels=10, radicals=8, kanji=12, vocabulary=20):
+        self.levels = levels
+        self.counts = {'radical': radicals, 'kanji': kanji, 'vocabulary': vocabulary}
+        self.layout = Template(load_fixture('layout.html'))
+        self.templates = {
+            'radical': Template(load_fixture('radical.html')),
+            'kanji': Template(load_fixture('kanji.html')),
+            'vocabulary': Template(load_fixture('vocab.html')),
+        }
+        self.svg = Template(load_fixture('radical.svg'))
+        self.audio = load_fixture('audio.mp3', 'rb')
+
+        self.subjects = []
+        subject_id = 0
+        for level in range(1, levels + 1):
+            for object_type in ('radical', 'kanji', 'vocabulary'):
+                for i in range(self.counts[object_type]):
+                    subject_id += 1
+                    self.subjects.append(self.subject(subject_id, object_type, level, i))
+        self.by_path = {subject['path']: subject for subject in self.subjects}
+
+    @staticmethod
+    def subject(subject_id, object_type, level, i):
+        if object_type == 'radical':
+            slug = 'radical-{}-{}'.format(level, i)
+            characters = chr(0x2f00 + subject_id % 214) if i % 3 else ''
+            document_path = '/radicals/' + slug
+        elif object_type == 'kanji':
+            characters = chr(0x4e00 + subject_id)
+            slug = characters
+            document_path = '/kanji/' + characters
+        else:
+            characters = chr(0x4e00 + subject_id) + chr(0x3041 + subject_id % 80)
+            slug = characters
+            document_path = '/vocabulary/' + characters
+
+        return {
+            'id': subject_id,
+            'object': object_type,
+            'level': level,
+            'slug': slug,
+            'characters': characters,
+            'meaning': '{}{}'.format(object_type, subject_id),
+            'path': document_path,
+            'updated_at': '2018-07-{:02d}T10:00:00.000000Z'.format(1 + subject_id % 28),
+        }
+
+    def api_data(self, subject, base):
+        data = {
+            'level': subject['level'],
+            'slug': subject['slug'],
+            'characters': subject['characters'] or None,
+            'document_url': 'https://www.wanikani.com' + quote(subject['path']),
+            'meanings': [{'meaning': subject['meaning'], 'primary': True}],
+            'lesson_position': subject['id'],
+            'hidden_at': None,
+        }
+        if subject['object'] == 'radical':
+            svg_url = base['site'] + '/radical-svgs/' + subject['slug'] + '.svg'
+            data['character_images'] = [
+                {'url': svg_url + '?plain', 'metadata': {'inline_styles': False}, 'content_type': 'image/svg+xml'},
+                {'url': svg_url, 'metadata': {'inline_styles': True}, 'content_type': 'image/svg+xml'},
+            ]
+        return {
+            'id': subject['id'],
+            'object': subject['object'],
+            'url': base['api'] + '/subjects/{}'.format(subject['id']),
+            'data_updated_at': subject['updated_at'],
+            'data': data,
+        }
+
+    def subjects_page(self, query, base, per_page):
+        levels = set(int(level) for level in query['levels'].split(',')) if 'levels' in query else None
+        types = set(query['types'].split(',')) if 'types' in query else None
+        updated_after = query.get('updated_after')
+        after_id = int(query.get('page_after_id', 0))
+
+        matching = [s for s in self.subjects
+                    if (levels is None or s['level'] in levels)
+                    and (types is None or s['object'] in types)
+                    and (updated_after is None or s['updated_at'] > updated_after)]
+        page = [s for s in matching if s['id'] > after_id][:per_page]
+
+        next_url = None
+        if page and page[-1]['id'] < matching[-1]['id']:
+            next_query = dict(query, page_after_id=str(page[-1]['id']))
+            next_url = base['api'] + '/subjects?' + '&'.join(
+                '{}={}'.format(key, quote(value, safe=',')) for key, value in sorted(next_query.items()))
+
+        return {
+            'object': 'collection',
+            'url': base['api'] + '/subjects',
+            'pages': {'per_page': per_page, 'next_url': next_url, 'previous_url': None},
+            'total_count': len(matching),
+            'data_updated_at': max((s['updated_at'] for s in matching), default=None),
+            'data': [self.api_data(s, base) for s in page],
+        }
+
+    def document(self, subject, base):
+        found_in = '\n    '.join('<li><a href="/kanji/{0}" lang="ja">{0}</a></li>'.format(chr(0x4e00 + j))
+                                for j in range(subject['id'] % 7 + 3))
+        content = self.templates[subject['object']].substitute(
+            level=subject['level'],
+            characters=subject['characters'],
+            meaning=subject['meaning'],
+            alternative='{0} alt, other {0}'.format(subject['meaning']),
+            on='いち', kun='ひと',
+            reading='ひとつ, いち',
+            # named like WaniKani's, by the quoted characters the export names the mp3 by
+            audio_url='{}/audio/{}-{}.mp3'.format(base['cdn'], subject['id'], quote(subject['characters'])),
+            audio_ogg='{}/audio/{}-{}.ogg'.format(base['cdn'], subject['id'], quote(subject['characters'])),
+            found_in=found_in,
+        )
+        return self.layout.substitute(content=content, title=subject['meaning'], id=subject['id'],
+                                      object=subject['object'], level=subject['level'], slug=subject['slug'])
+
+
+class RateLimit:
+    # Server side token bucket, requests over the limit get a 429 with Retry-After.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
+
+
+class Stats:
+    # Per request kind (api, page, svg, audio): count, 429s, bytes, in flight and its peak, first/last time.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+
+    def reset(self):
+        with self.lock:
+            self.kinds = {}
+
+    def begin(self, kind):
+        with self.lock:
+            stats = self.kinds.setdefault(kind, {
+                'requests': 0, 'rate_limited': 0, 'bytes': 0, 'in_flight': 0, 'peak_concurrency': 0,
+                'first': time(), 'last': time()})
+            stats['requests'] += 1
+            stats['in_flight'] += 1
+            stats['peak_concurrency'] = max(stats['peak_concurrency'], stats['in_flight'])
+
+    def end(self, kind, status, size):
+        with self.lock:
+            stats = self.kinds[kind]
+            stats['in_flight'] -= 1
+            stats['bytes'] += size
+            stats['last'] = time()
+            if status == 429:
+                stats['rate_limited'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for kind, stats in self.kinds.items():
+                stats = dict(stats)
+                seconds = stats.pop('last') - stats.pop('first')
+                stats.pop('in_flight')
+                stats['seconds'] = seconds
+                stats['requests_per_second'] = stats['requests'] / seconds if seconds > 0 else None
+                result[kind] = stats
+            return result
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        document_path = unquote(url.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if document_path.startswith('/v2/'):
+            kind = 'api'
+        elif document_path.startswith('/radical-svgs/'):
+            kind = 'svg'
+        elif document_path.startswith('/audio/'):
+            kind = 'audio'
+        else:
+            kind = 'page'
+
+        server.stats.begin(kind)
+        status, size = 500, 0
+        try:
+            status, size = self.respond(kind, document_path, query)
+        finally:
+            server.stats.end(kind, status, size)
+
+    def respond(self, kind, document_path, query):
+        server = self.server
+        catalog = server.catalog
+
+        limit = server.limits.get(kind)
+        retry_after = limit.take() if limit else None
+        if retry_after is not None:
+            return self.send(429, b'{"error": "Rate limit exceeded", "code": 429}', 'application/json',
+                             {'Retry-After': '{:.2f}'.format(retry_after)})
+
+        if server.latency:
+            sleep(server.latency)
+
+        if kind == 'api':
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                return self.send(401, b'{"error": "Unauthorized", "code": 401}', 'application/json')
+            if document_path != '/v2/subjects':
+                return self.send(404, b'{"error": "Not found", "code": 404}', 'application/json')
+            body = catalog.subjects_page(query, server.base, server.per_page)
+            return self.send(200, json.dumps(body).encode('utf-8'), 'application/json')
+
+        if kind == 'svg':
+            slug = document_path[len('/radical-svgs/'):-len('.svg')]
+            return self.send_page(catalog.svg.substitute(slug=slug), 'image/svg+xml')
+
+        if kind == 'audio':
+            return self.send(200, catalog.audio, 'audio/mpeg')
+
+        subject = catalog.by_path.get(document_path)
+        if subject is None:
+            return self.send(404, b'Not found', 'text/plain')
+        return self.send_page(catalog.document(subject, server.base))
+
+    def send_page(self, text, content_type='text/html; charset=utf-8'):
+        body = text.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, b'', content_type, {'ETag': etag})
+        return self.send(200, body, content_type, {'ETag': etag})
+
+    def send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        return status, len(body)
+
+
+class BenchmarkServer(ThreadingMixIn, HTTPServer):
+    # ThreadingMixIn rather than http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+    # rate limits: kind -> (requests per second, burst), kinds without an entry are unlimited
+    def __init__(self, catalog, rate_limits=None, latency=0.0, per_page=100, host='127.0.0.1', port=0):
+        super().__init__((host, port), Handler)
+        self.catalog = catalog
+        self.limits = {}
+        for kind, (rate, burst) in (rate_limits or {}).items():
+            limit = RateLimit(rate, burst)
+            for k in (('page', 'svg') if kind == 'site' else (kind,)):
+                self.limits[k] = limit
+        self.latency = latency
+        self.per_page = per_page
+        self.stats = Stats()
+
+        # The api answers on localhost and the site and cdn on 127.0.0.1, so the importer sees two hosts
+        # and keeps a separate limiter for each, like it does for api.wanikani.com and www.wanikani.com.
+        port = self.server_address[1]
+        self.base = {
+            'api': 'http://localhost:{}/v2'.format(port),
+            'site': 'http://{}:{}'.format(host, port),
+            'cdn': 'http://{}:{}'.format(host, port),
+        }
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,20 +1,210 @@
+import argparse
 import configparser
+from os import makedirs
 
-from wanianki.importer import Importer, Exporter, Store
+from wanianki.metrics import metrics
+from wanianki.selection import Selection
+
+# The importer, the exporter and the parsers (requests, bs4, lxml, asyncio, multiprocessing) are imported only by
+# the commands that use them, so status answers right away.
+
+
+def parse_args():
+    # --levels, --types, --account and the metrics options go before or after the command
+    account = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    account.add_argument('--account', metavar='NAMES',
+                         help='only these of the [account NAME] sections in config.ini, comma separated')
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS, parents=[account])
+    common.add_argument('--levels', help='only crawl and export these levels, like 1-10 or 1,3,5-7')
+    common.add_argument('--types', help='only crawl and export these item types, like kanji,vocab '
+                                        '(radical, kanji, vocab)')
+    common.add_argument('--metrics', metavar='FILE',
+                        help='write request, store and extraction timings, bytes, retries and stage throughput '
+                             'to FILE as json')
+    common.add_argument('--live-metrics', action='store_true',
+                        help='show throughput, eta, latencies, limiter sleep and retries instead of the progress')
+    common.add_argument('--profile-extraction', metavar='DIR',
+                        help='cProfile the extraction, one .prof file per worker process in DIR')
+
+    parser = argparse.ArgumentParser(description='Exports WaniKani content to Anki. Without a command it crawls '
+                                                 'and then exports.', parents=[common])
+    parser.add_argument('--verify-parser', metavar='PARSER',
+                        help='only check that PARSER extracts the same records as bs4 from the stored pages')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.add_parser('crawl', parents=[common], help='download the subjects, pages, svgs and mp3s')
+    commands.add_parser('extract', parents=[common],
+                        help='extract the stored pages into the extraction cache, without writing the output')
+    commands.add_parser('export', parents=[common], help='write the csv or apkg from the stored pages')
+    validate = commands.add_parser('validate', parents=[common],
+                                   help='check the stored pages for the markup the extraction relies on')
+    validate.add_argument('--max-failures', type=int, default=20, metavar='N',
+                          help='stop after N failing pages (default 20)')
+    commands.add_parser('status', parents=[account],
+                        help='show what is downloaded and what is missing, without network access')
+    return parser, parser.parse_args()
+
+
+def select_accounts(config, names=None):
+    # (name, config section with key and session_cookie) of every account to run: the [account NAME] sections,
+    # or just [app] without a name if there are none.
+    accounts = [(section[len('account '):].strip(), config[section]) for section in config.sections()
+                if section.startswith('account ')]
+    if not accounts:
+        if names:
+            raise ValueError('--account needs [account NAME] sections in config.ini')
+        return [(None, config['app'] if config.has_section('app') else {})]
+    if names:
+        wanted = [name.strip() for name in names.split(',')]
+        unknown = set(wanted) - set(name for name, section in accounts)
+        if unknown:
+            raise ValueError('Unknown accounts: ' + ', '.join(sorted(unknown)))
+        accounts = [(name, section) for name, section in accounts if name in wanted]
+    return accounts
+
+
+def open_store(config, account_name=None, migrate=True):
+    # migrate=False for status, which reads the downloaded files instead of copying them into a new sqlite database
+    from wanianki.store import Store
+
+    # every account has its own directory, the shared cache holds what they have in common
+    store_section = config['store'] if config.has_section('store') else {}
+    directory = 'imported/' if account_name is None else 'imported/' + account_name + '/'
+    shared = store_section.get('shared_cache')
+
+    if store_section.get('backend', 'files') == 'sqlite':
+        from wanianki.sqlite_store import SqliteStore
+        store = SqliteStore(directory)
+        if not store.has_all_subjects():
+            if not migrate:
+                print('[store] the database is still empty, the files are copied into it on the next crawl or export')
+                return Store(directory)
+            store.copy_from(Store(directory))
+        return store
+    return Store(directory, shared)
+
+
+def create_importer(config, account, store, selection):
+    from wanianki.importer import Importer
+
+    key = account['key']
+    session_cookie = account['session_cookie']
+
+    crawl = config['crawl'] if config.has_section('crawl') else {}
+    concurrency = int(crawl.get('concurrency', 1))
+    rate_limits = {
+        'api.wanikani.com': (float(crawl.get('api_rate', 1 / 1.1)), int(crawl.get('api_burst', 1))),
+        'www.wanikani.com': (float(crawl.get('site_rate', 1 / 1.1)), int(crawl.get('site_burst', 1))),
+    }
+    pool_size = int(crawl['pool_size']) if 'pool_size' in crawl else None
+    timeout = (float(crawl.get('connect_timeout', 10)), float(crawl.get('read_timeout', 60)))
+    backend = crawl.get('backend', 'threads')
+    audio_concurrency = int(crawl.get('audio_concurrency', 8))
+    incremental = crawl.getboolean('incremental', False) if config.has_section('crawl') else False
+    job_attempts = int(crawl.get('job_attempts', 3))
+    job_backoff = float(crawl.get('job_backoff', 5))
+    concurrent_paging = crawl.getboolean('concurrent_paging', True) if config.has_section('crawl') else True
+
+    page_parser = config['export'].get('parser', 'bs4') if config.has_section('export') else 'bs4'
+
+    return Importer(store, key, session_cookie, concurrency, rate_limits,
+                    pool_size=pool_size, timeout=timeout, backend=backend,
+                    audio_concurrency=audio_concurrency, incremental=incremental,
+                    parser=page_parser, selection=selection, job_attempts=job_attempts,
+                    job_backoff=job_backoff, concurrent_paging=concurrent_paging)
+
+
+def create_exporter(config, store, selection):
+    from wanianki.importer import Exporter
+
+    export = config['export'] if config.has_section('export') else {}
+    page_parser = export.get('parser', 'bs4')
+    workers = int(export['workers']) if 'workers' in export else None
+    output = export.get('output', 'csv')
+    radical_svgs = export.get('radical_svgs', 'inline')
+
+    return Exporter(store, page_parser, workers, output=output, selection=selection, radical_svgs=radical_svgs)
+
+
+def announce(account_name, accounts):
+    if len(accounts) > 1 or account_name is not None:
+        print('[account {}]'.format(account_name))
 
 
 def run():
+    parser, args = parse_args()
+
     config = configparser.ConfigParser()
     config.read('config.ini')
 
-    key = config['app']['key']
-    session_cookie = config['app']['session_cookie']
+    try:
+        accounts = select_accounts(config, getattr(args, 'account', None))
+    except ValueError as e:
+        parser.error(str(e))
+    if config.has_section('store') and config['store'].get('shared_cache') \
+            and config['store'].get('backend', 'files') == 'sqlite':
+        parser.error('[store] shared_cache needs backend = files')
+
+    if args.command == 'status':
+        from wanianki.status import status
+        for account_name, account in accounts:
+            announce(account_name, accounts)
+            status(open_store(config, account_name, migrate=False))
+        return
+
+    profile_extraction = getattr(args, 'profile_extraction', None)
+    if getattr(args, 'metrics', None) or getattr(args, 'live_metrics', False) or profile_extraction:
+        metrics.enable(getattr(args, 'metrics', None), getattr(args, 'live_metrics', False), profile_extraction)
+        if profile_extraction:
+            makedirs(profile_extraction, exist_ok=True)
+
+    try:
+        selection = Selection.parse(getattr(args, 'levels', None), getattr(args, 'types', None))
+    except ValueError as e:
+        parser.error(str(e))
+
+    from wanianki.importer import CrawlIncomplete
+
+    # Accounts run one after another, run main.py --account NAME in parallel to crawl them at the same time.
+    failed = False
+    try:
+        for account_name, account in accounts:
+            announce(account_name, accounts)
+            store = open_store(config, account_name)
+            try:
+                if run_command(args, config, account, store, selection) is False:
+                    failed = True
+            except CrawlIncomplete as e:
+                print('[crawl incomplete] {}'.format(e))
+                failed = True
+    finally:
+        metrics.write()
+    if failed:
+        raise SystemExit(1)
+
+
+def run_command(args, config, account, store, selection):
+    if args.verify_parser:
+        create_exporter(config, store, selection).verify_parser(args.verify_parser)
+        return
 
-    store = Store()
-    importer = Importer(store, key, session_cookie)
-    importer.run()
-    exporter = Exporter(store)
-    exporter.run()
+    pipelined = config['export'].getboolean('pipeline', False) if config.has_section('export') else False
+    if args.command == 'crawl':
+        create_importer(config, account, store, selection).run()
+    elif args.command == 'extract':
+        create_exporter(config, store, selection).extract_pages()
+    elif args.command == 'export':
+        create_exporter(config, store, selection).run()
+    elif args.command == 'validate':
+        return not create_exporter(config, store, selection).validate_pages(args.max_failures)
+    else:
+        # both built up front, a wrong [export] setting fails before the crawl, not after it
+        importer = create_importer(config, account, store, selection)
+        exporter = create_exporter(config, store, selection)
+        if pipelined:
+            exporter.run_pipelined(importer)
+        else:
+            importer.run()
+            exporter.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import re
+import sqlite3
+import zipfile
+from os import path
+from time import time
+
+from wanianki.importer import CsvBucketWriter
+
+# Fixed ids, so importing a newer package updates the notes of an earlier import instead of duplicating them.
+model_id = 1534790134761
+deck_id = 1534790134762
+
+anki_path = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'ANKI')
+
+schema = '''
+CREATE TABLE col (
+    id integer primary key, crt integer not null, mod integer not null, scm integer not null,
+    ver integer not null, dty integer not null, usn integer not null, ls integer not null,
+    conf text not null, models text not null, decks text not null, dconf text not null, tags text not null
+);
+CREATE TABLE notes (
+    id integer primary key, guid text not null, mid integer not null, mod integer not null,
+    usn integer not null, tags text not null, flds text not null, sfld integer not null,
+    csum integer not null, flags integer not null, data text not null
+);
+CREATE TABLE cards (
+    id integer primary key, nid integer not null, did integer not null, ord integer not null,
+    mod integer not null, usn integer not null, type integer not null, queue integer not null,
+    due integer not null, ivl integer not null, factor integer not null, reps integer not null,
+    lapses integer not null, left integer not null, odue integer not null, odid integer not null,
+    flags integer not null, data text not null
+);
+CREATE TABLE revlog (
+    id integer primary key, cid integer not null, usn integer not null, ease integer not null,
+    ivl integer not null, lastIvl integer not null, factor integer not null, time integer not null,
+    type integer not null
+);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+'''
+
+
+def load_note_type():
+    # The ANKI file is the single source for the fields, card templates and css.
+    with open(anki_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    fields_text = text[text.index('Fields:') + len('Fields:'):text.index('Templates')]
+    fields = [line.strip() for line in fields_text.splitlines() if line.strip()]
+
+    templates = []
+    css = ''
+    for match in re.finditer(r'^([^\n]+):\nFront:\n```\n(.*?)```\n\s*Back:\n```\n(.*?)```\n\s*CSS:\n```\n(.*?)```',
+                             text, re.MULTILINE | re.DOTALL):
+        name, front, back, css = match.groups()
+        templates.append((name.strip(), front, back))
+
+    return fields, templates, css
+
+
+def required_fields(template, fields):
+    referenced = set(re.findall(r'{{[#^/]?([^}]+)}}', template))
+    return [i for i, field in enumerate(fields) if field in referenced]
+
+
+def checksum(value):
+    return int(hashlib.sha1(re.sub(r'<[^>]*>', '', value).encode('utf-8')).hexdigest()[:8], 16)
+
+
+class ApkgWriter(CsvBucketWriter):
+    # Exporter sink that writes a ready to import Anki package instead of a csv.
+    # Rows are ordered exactly like the csv. Media files are streamed from the store into the archive, and files
+    # with identical content are packed once, the notes referencing a duplicate are pointed at the packed copy.
+    def __init__(self, output_path, spool_dir, store, deck_name='WaniKani'):
+        super().__init__(output_path, spool_dir)
+        self.store = store
+        self.deck_name = deck_name
+        # referenced media that isn't in the store, an incomplete crawl
+        self.missing_media = 0
+
+    def media_for(self, row):
+        # (field index, filename, path on disk) of the media a row references, the ones not on disk are counted
+        fields = self.fields
+        audio = re.match(r'\[sound:(.+)\]$', row[fields.index('Audio')])
+        if audio:
+            name = audio.group(1)
+            filepath = self.store.get_audio_path(name[:-len('.mp3')])
+            if path.isfile(filepath):
+                yield fields.index('Audio'), name, filepath
+            else:
+                self.missing_media += 1
+        # radical svgs exported as media files
+        for image in re.finditer(r'src="(wanikani_radical_([0-9a-f]+)\.svg)"', row[fields.index('Subject')]):
+            filepath = self.store.get_prepared_svg_path(image.group(2))
+            if path.isfile(filepath):
+                yield fields.index('Subject'), image.group(1), filepath
+            else:
+                self.missing_media += 1
+
+    def finish(self):
+        self.fields, templates, css = load_note_type()
+        now = int(time())
+
+        collection_path = path.join(self.spool.name, 'collection.anki2')
+        db = sqlite3.connect(collection_path)
+        db.executescript(schema)
+
+        media_by_hash = {}
+        media = {}
+        notes = 0
+
+        with zipfile.ZipFile(self.output_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for position, row in enumerate(self.sorted_rows()):
+                row = list(row)
+
+                for index, name, filepath in self.media_for(row):
+                    digest = file_digest(filepath)
+                    packed = media_by_hash.get(digest)
+                    if packed is None:
+                        packed = media_by_hash[digest] = name
+                        # mp3s are already compressed, svgs aren't
+                        compression = zipfile.ZIP_STORED if name.endswith('.mp3') else zipfile.ZIP_DEFLATED
+                        archive.write(filepath, str(len(media)), compression)
+                        media[str(len(media))] = name
+                    if packed != name:
+                        row[index] = row[index].replace(name, packed)
+
+                notes += 1
+                note_id = now * 1000 + position
+                link = row[self.fields.index('WaniKani link')]
+                guid = hashlib.sha1(link.encode('utf-8')).hexdigest()[:10]
+                db.execute('INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    note_id, guid, model_id, now, -1, ' ', '\x1f'.join(row), row[0], checksum(row[0]), 0, ''))
+                for ord, template in enumerate(templates):
+                    db.execute('INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                        note_id * 10 + ord, note_id, deck_id, ord, now, -1, 0, 0, position, 0, 0, 0, 0, 0, 0, 0, 0,
+                        ''))
+
+            self.write_collection(db, templates, css, now)
+            db.commit()
+            db.close()
+
+            archive.write(collection_path, 'collection.anki2')
+            archive.writestr('media', json.dumps(media))
+
+        print('[Packed {} notes, {} media files, {} missing]'.format(notes, len(media), self.missing_media))
+
+    def write_collection(self, db, templates, css, now):
+        model = {
+            'id': model_id, 'name': self.deck_name, 'type': 0, 'mod': now, 'usn': -1, 'sortf': 0, 'did': deck_id,
+            'tags': [], 'vers': [], 'latexPre': '', 'latexPost': '', 'css': css,
+            'flds': [{'name': name, 'ord': i, 'sticky': False, 'rtl': False, 'font': 'Arial', 'size': 20,
+                      'media': []} for i, name in enumerate(self.fields)],
+            'tmpls': [{'name': name, 'ord': i, 'qfmt': front, 'afmt': back, 'did': None, 'bqfmt': '', 'bafmt': ''}
+                      for i, (name, front, back) in enumerate(templates)],
+            'req': [[i, 'any', required_fields(front, self.fields)] for i, (name, front, back) in enumerate(templates)],
+        }
+
+        def deck(did, name):
+            return {'id': did, 'name': name, 'desc': '', 'mod': now, 'usn': -1, 'dyn': 0, 'conf': 1,
+                    'collapsed': False, 'extendNew': 10, 'extendRev': 50,
+                    'newToday': [0, 0], 'revToday': [0, 0], 'lrnToday': [0, 0], 'timeToday': [0, 0]}
+
+        conf = {'activeDecks': [1], 'curDeck': 1, 'newSpread': 0, 'collapseTime': 1200, 'timeLim': 0,
+                'estTimes': True, 'dueCounts': True, 'curModel': None, 'nextPos': 1, 'sortType': 'noteFld',
+                'sortBackwards': False, 'addToCur': True}
+        dconf = {'1': {
+            'id': 1, 'name': 'Default', 'mod': 0, 'usn': 0, 'dyn': False, 'maxTaken': 60, 'timer': 0,
+            'autoplay': True, 'replayq': True,
+            'new': {'bury': True, 'delays': [1, 10], 'initialFactor': 2500, 'ints': [1, 4, 7], 'order': 1,
+                    'perDay': 20, 'separate': True},
+            'lapse': {'delays': [10], 'leechAction': 0, 'leechFails': 8, 'minInt': 1, 'mult': 0},
+            'rev': {'bury': True, 'ease4': 1.3, 'fuzz': 0.05, 'ivlFct': 1, 'maxIvl': 36500, 'minSpace': 1,
+                    'perDay': 100},
+        }}
+
+        db.execute('INSERT INTO col VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            1, now, now * 1000, now * 1000, 11, 0, 0, 0, json.dumps(conf),
+            json.dumps({str(model_id): model}),
+            json.dumps({'1': deck(1, 'Default'), str(deck_id): deck(deck_id, self.deck_name)}),
+            json.dumps(dconf), json.dumps({})))
+
+
+def file_digest(filepath):
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
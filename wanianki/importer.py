@@ -1,236 +1,447 @@
 import asyncio
 import csv
+import hashlib
 import json
 import re
 from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from itertools import zip_longest
 from multiprocessing import cpu_count
-from os import path, makedirs
-from time import time
+from os import path
+from tempfile import TemporaryDirectory
 
-import requests
 import shutil
-from bs4 import BeautifulSoup
-from urllib.parse import quote
+from urllib.parse import quote, unquote, urlparse
 
 from multiprocessing.pool import Pool
 
+from wanianki.ledger import JobLedger
+from wanianki.metrics import metrics, init_worker
+from wanianki.selection import Selection, item_types
+from wanianki.store import Store
+from wanianki.subjects import SubjectIndex
+from wanianki.svg import prepared_radical_image, prepare_radical_images, prepare_version, sizing as svg_sizing
+from wanianki.record import ItemRecord
+from wanianki.validate import broken_checks, describe as describe_check
+from wanianki.ratelimit import TokenBucket, RateLimited, parse_retry_after
+from wanianki.transport import AiohttpTransport, has_aiohttp, IncompleteDownload, resume_offset, range_headers, \
+    expected_size, discard_partial, finish_download, partial_path, conditional_headers, response_validators
+
+
+class CsvBucketWriter:
+    # Writes the csv ordered by level and type without holding all rows in memory.
+    # Rows are spooled to one temporary file per (level, type) bucket as they arrive, in any order, and finish()
+    # merges the buckets in order. Within a bucket rows are sorted on their position in the lattice list.
+    # At most `max_open` bucket files are open at once (60 levels x 3 types would be 180), the least recently
+    # written one is closed and later reopened for appending.
+    max_open = 16
+
+    def __init__(self, output_path, spool_dir):
+        self.output_path = output_path
+        self.spool = TemporaryDirectory(dir=spool_dir)
+        self.buckets = set()
+        # (level, type) -> (file, csv writer), least recently written first
+        self.open_buckets = OrderedDict()
+
+    def bucket_path(self, key):
+        return path.join(self.spool.name, '{}_{}.csv'.format(*key))
+
+    def add(self, position, level, type_order, row):
+        key = (level, type_order)
+        bucket = self.open_buckets.pop(key, None)
+        if bucket is None:
+            if len(self.open_buckets) >= self.max_open:
+                self.open_buckets.popitem(last=False)[1][0].close()
+            f = open(self.bucket_path(key), 'a' if key in self.buckets else 'w', newline='', encoding='utf-8')
+            bucket = (f, csv.writer(f))
+            self.buckets.add(key)
+        self.open_buckets[key] = bucket
+        bucket[1].writerow((position,) + tuple(row))
+
+    def close_buckets(self):
+        for f, writer in self.open_buckets.values():
+            f.close()
+        self.open_buckets.clear()
+
+    def sorted_rows(self):
+        self.close_buckets()
+
+        for key in sorted(self.buckets):
+            with open(self.bucket_path(key), 'r', newline='', encoding='utf-8') as f:
+                rows = sorted(csv.reader(f), key=lambda i: int(i[0]))
+            for row in rows:
+                yield row[1:]
+
+    def finish(self):
+        with open(self.output_path, 'w', newline='', encoding='utf-8') as out:
+            writer = csv.writer(out)
+
+            # noinspection PyUnreachableCode
+            if False:
+                writer.writerow((
+                    'Sort field', 'Subject', 'Level', 'Item type', 'Primary meaning', 'Additional meanings',
+                    'Part of speech', 'Primary reading', 'Additional readings',
+                    'Onyomi reading', 'Kunyomi reading', 'Nanori reading',
+                    'Meaning mnemonic', 'Reading mnemonic', 'Context sentences', 'Audio', 'WaniKani link'
+                ))
+
+            writer.writerows(self.sorted_rows())
+
+    def close(self):
+        self.close_buckets()
+        self.spool.cleanup()
 
-class Store:
-    def __init__(self):
-        self.directory = 'imported/'
 
-        makedirs(self.dir('pages'), exist_ok=True)
-        makedirs(self.dir('radical_svgs'), exist_ok=True)
-        makedirs(self.dir('audio'), exist_ok=True)
-
-    def dir(self, subdir):
-        return self.directory + subdir
-
-    def isfile(self, filepath):
-        return path.isfile(filepath)
-
-    def store_json(self, filepath, data):
-        with open(self.dir(filepath), 'w') as f:
-            json.dump(data, f, indent=2)
-
-    def load_json(self, filepath):
-        with open(self.dir(filepath), 'r') as f:
-            return json.load(f)
-
-    def has_all_subjects(self):
-        return self.isfile(self.dir('all_subjects.json'))
-
-    def store_all_subjects(self, subjects):
-        self.store_json('all_subjects.json', subjects)
-
-    def get_all_subjects(self):
-        return self.load_json('all_subjects.json')
-
-    def store_lattice_list(self, name, urls):
-        self.store_json(name + '_list.json', urls)
-
-    def get_lattice_list(self, name):
-        return self.load_json(name + '_list.json')
-
-    def has_lattice_list(self, name):
-        return self.isfile(self.dir(name + '_list.json'))
-
-    def has_page(self, url):
-        return self.isfile(self.dir('pages/' + url.replace('/', '_')))
-
-    def store_page(self, page, url):
-        with open(self.dir('pages/' + url.replace('/', '_')), 'w', encoding='utf-8') as f:
-            f.write(page)
+class Exporter:
+    # Extraction backends, selectable with [export] parser. 'bs4' is the reference implementation.
+    parsers = ('bs4', 'lxml')
 
-    def load_page(self, url):
-        with open(self.dir('pages/' + url.replace('/', '_')), 'r', encoding='utf-8') as f:
-            return f.read()
+    # Bump when extract returns something different for the same page, it invalidates all cached records.
+    extractor_version = 3
 
-    def has_radical_image(self, slug):
-        return self.isfile(self.dir('radical_svgs/' + slug + '.svg'))
+    # Output sinks, selectable with [export] output: the csv, or an Anki package with notes, templates and media.
+    outputs = ('csv', 'apkg')
 
-    def store_radical_image(self, content, slug):
-        with open(self.dir('radical_svgs/' + slug + '.svg'), 'w', encoding='utf-8') as f:
-            f.write(content)
+    # Radical svgs in the Subject field: the prepared svg itself, or an <img> of the svg as a media file.
+    radical_svg_modes = ('inline', 'media')
 
-    def load_radical_image(self, slug):
-        with open(self.dir('radical_svgs/' + slug + '.svg'), 'r', encoding='utf-8') as f:
-            return f.read()
+    def __init__(self, store, parser='bs4', workers=None, serial_threshold=64, output='csv', selection=None,
+                 radical_svgs='inline'):
+        self.store = store
+        if radical_svgs not in Exporter.radical_svg_modes:
+            raise ValueError(('Unknown radical svg mode', radical_svgs))
+        self.svg_media = radical_svgs == 'media'
+        self.selection = selection or Selection()
+        if output not in Exporter.outputs:
+            raise ValueError(('Unknown output', output))
+        self.output = output
+        if parser not in Exporter.parsers:
+            raise ValueError(('Unknown parser', parser))
+        self.parser = parser
+        # Parsing is CPU bound, more processes than cores only adds contention.
+        self.workers = workers or cpu_count()
+        # Below this many pages a pool costs more to start than it saves, they are extracted in-process.
+        self.serial_threshold = serial_threshold
+
+    def create_writer(self):
+        if self.output == 'apkg':
+            from wanianki.apkg import ApkgWriter
+            return ApkgWriter(self.store.get_package_path(), self.store.dir(''), self.store)
+        return CsvBucketWriter(self.store.get_output_path(), self.store.dir(''))
+
+    def map_pages(self, fn, tasks, parser=None):
+        # Runs fn over (item type, url) tasks in order. The pool workers get the store and parser once through
+        # the initializer instead of having them pickled into every task.
+        if len(tasks) < self.serial_threshold:
+            init_extraction_worker(self.store, parser or self.parser, None, self.svg_media)
+            with metrics.profile('extraction-serial'):
+                yield from map(fn, tasks)
+            return
+
+        # A few chunks per worker: big enough to amortize the IPC, small enough to balance the load.
+        chunksize = max(1, min(64, len(tasks) // (self.workers * 8)))
+        initargs = (self.store, parser or self.parser, metrics.worker_setup(), self.svg_media)
+        with Pool(self.workers, init_extraction_worker, initargs) as pool:
+            yield from pool.imap(fn, tasks, chunksize)
+            # let the workers exit on their own, so they write their metrics and profiles
+            pool.close()
+            pool.join()
+
+    def selected_lists(self):
+        paths = None
+        if not self.selection.is_all():
+            paths = SubjectIndex.from_store(self.store, self.selection).paths(self.selection)
+        item_lists = []
+        for item_type, name in (('radical', 'radicals'), ('kanji', 'kanji'), ('vocab', 'vocabulary')):
+            if not self.selection.has_type(item_type):
+                continue
+            # a type left out of the crawls so far, like after main.py --types kanji crawl
+            if not self.store.has_lattice_list(name):
+                print('[{}] no page list yet, crawl it to export it'.format(item_type))
+                continue
+            item_lists.append((item_type, self.selection.filter_urls(self.store.get_lattice_list(name), paths)))
+        return item_lists
 
-    def store_audio_list(self, audios):
-        self.store_json('audio_list.json', audios)
+    def run(self):
+        item_lists = self.selected_lists()
 
-    def load_audio_list(self):
-        return self.load_json('audio_list.json')
+        tasks = []
+        positions = []
+        for type_and_list in item_lists:
+            item_type, item_list = type_and_list
+            for position, url in enumerate(item_list):
+                tasks.append((item_type, url))
+                positions.append(position)
+
+        writer = self.create_writer()
+        try:
+            total = len(tasks)
+            for i, (level, type_order, row) in enumerate(self.map_pages(extract_row_in_worker, tasks)):
+                dump_progress(i, total, 'Extracting data from pages')
+                writer.add(positions[i], level, type_order, row)
+            writer.finish()
+        finally:
+            writer.close()
+
+    def extract_pages(self):
+        # Fills the extraction cache for the selected pages without writing an output, a later run() then only
+        # reads the cached records.
+        tasks = [(item_type, url) for item_type, item_list in self.selected_lists() for url in item_list]
+        for i, _ in enumerate(self.map_pages(extract_in_worker, tasks)):
+            dump_progress(i, len(tasks), 'Extracting data from pages')
+        print('')
 
-    def has_audio_list(self):
-        return self.isfile(self.dir('audio_list.json'))
+    def run_pipelined(self, importer: 'Importer', workers=None, queue_size=64):
+        # Crawl and extract at the same time: every page the importer has on disk goes onto a bounded queue
+        # that feeds the extraction processes right away, and the csv is written once the last page is in.
+        importer.run(self.pipeline(importer, workers or self.workers, queue_size))
+
+    async def pipeline(self, importer: 'Importer', workers, queue_size):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(queue_size)
+        writer = self.create_writer()
+        extracted = 0
+        errors = []
+
+        def extract_row_in_pool(pool, task):
+            # a future the event loop can wait for, set from the pool's result thread
+            future = loop.create_future()
+
+            def settle(set_outcome, outcome):
+                if not future.cancelled():
+                    set_outcome(outcome)
+
+            pool.apply_async(extract_row_in_worker, (task,),
+                             callback=lambda row: loop.call_soon_threadsafe(settle, future.set_result, row),
+                             error_callback=lambda e: loop.call_soon_threadsafe(settle, future.set_exception, e))
+            return future
+
+        try:
+            # multiprocessing.Pool, the initializer of ProcessPoolExecutor needs Python 3.7
+            with Pool(workers, init_extraction_worker,
+                      (self.store, self.parser, metrics.worker_setup(), self.svg_media)) as pool:
+                async def consume():
+                    nonlocal extracted
+                    while True:
+                        item = await queue.get()
+                        if item is None:
+                            return
+                        position, task = item
+                        try:
+                            level, type_order, row = await extract_row_in_pool(pool, task)
+                        except Exception as e:
+                            # keep draining the queue so the crawl doesn't block, fail after it finished
+                            errors.append((task[1], e))
+                            continue
+                        writer.add(position, level, type_order, row)
+                        extracted += 1
+
+                async def sink(item_type, position, url):
+                    # the extraction processes read the page from the store, so it has to be committed
+                    self.store.flush()
+                    await queue.put((position, (item_type, url)))
+
+                consumers = [asyncio.ensure_future(consume()) for _ in range(workers)]
+                importer.page_sink = sink
+                try:
+                    await importer.start()
+                finally:
+                    importer.page_sink = None
+                    for _ in consumers:
+                        await queue.put(None)
+                    await asyncio.gather(*consumers)
+
+                # let the workers exit on their own, so they write their metrics and profiles
+                pool.close()
+                pool.join()
+
+            if errors:
+                raise Exception(('Extraction failed', len(errors), errors[0]))
+
+            print('[Extracted {} pages while crawling]'.format(extracted))
+            writer.finish()
+        finally:
+            writer.close()
 
-    def has_audio(self, name):
-        return self.isfile(self.dir('audio/' + name + '.mp3'))
+    @staticmethod
+    def extract_row(args, svg_media=False):
+        # runs in the pool: the worker sends back the finished csv row, not the whole record
+        return Exporter.format_row(Exporter.extract_from_page(args), svg_media)
 
-    def get_audio_path(self, name):
-        return self.dir('audio/' + name + '.mp3')
+    @staticmethod
+    def format_row(result: ItemRecord, svg_media=False):
+        def add_mute(value):
+            return '<span class="reading-muted">' + value + '</span>'
 
-    def get_output_path(self):
-        return self.dir('wanikani_export.csv')
+        item_type = result.item_type
+        if item_type == 'Radical':
+            type_order = 0
+            sort_field_type = '1 r'
+            sort_field_value = result.radical_slug
+        elif item_type == 'Kanji':
+            type_order = 1
+            sort_field_type = '2 k'
+            sort_field_value = result.subject
+        elif item_type == 'Vocabulary':
+            type_order = 2
+            sort_field_type = '3 v'
+            sort_field_value = result.subject
+
+        sort_field = '{0:02d} {1} {2}'.format(result.level, sort_field_type, sort_field_value)
+
+        subject = result.subject
+        if svg_media and result.radical_image:
+            subject = '<img class="radical-image" src="{}" style="{}">'.format(result.radical_image, svg_sizing)
+
+        onyomi_reading = result.on_reading
+        if onyomi_reading and result.on_muted:
+            onyomi_reading = add_mute(onyomi_reading)
+
+        kunyomi_reading = result.kun_reading
+        if kunyomi_reading and result.kun_muted:
+            kunyomi_reading = add_mute(kunyomi_reading)
+
+        nanori_reading = result.nanori_reading
+        if nanori_reading and result.nanori_muted:
+            nanori_reading = add_mute(nanori_reading)
+
+        audio = '[sound:{}]'.format(result.audio_path) if result.audio_path else ''
+
+        # the fields of the ANKI file, in order
+        row = (
+            sort_field,
+            subject,
+            result.level,
+            result.item_type,
+            result.primary_meaning,
+            result.additional_meanings,
+            result.part_of_speech,
+            result.primary_reading,
+            result.additional_readings,
+            onyomi_reading,
+            kunyomi_reading,
+            nanori_reading,
+            result.meaning,
+            result.reading,
+            result.context_sentences,
+            audio,
+            result.link,
+        )
+        return result.level, type_order, row
 
+    # multiprocess-safe (does call a few store methods, but those are also multiprocess-safe).
+    @staticmethod
+    def extract_from_page(args):
+        # extracted records are cached by content, so every page is parsed only once for audio and export,
+        # and only changed pages are parsed again on the next export
+        store, item_type, url, parser = args
 
-class Exporter:
-    def __init__(self, store):
-        self.store = store
+        html = store.load_page(url[1:])
+        key = Exporter.extraction_key(store, item_type, url, parser, html)
+        if store.has_extraction(key):
+            metrics.add('extract.cached')
+            return store.load_extraction(key)
 
-    def run(self):
-        item_lists = [
-            ('radical', self.store.get_lattice_list('radicals')),
-            ('kanji', self.store.get_lattice_list('kanji')),
-            ('vocab', self.store.get_lattice_list('vocabulary')),
-        ]
+        with metrics.time('extract.' + parser):
+            result = Exporter.extract(store, item_type, url, parser, html)
+        store.store_extraction(result, key)
+        return result
 
-        queue = []
-        for type_and_list in item_lists:
-            item_type, item_list = type_and_list
+    @staticmethod
+    def extraction_key(store, item_type, url, parser, html):
+        # with the parser, the records of bs4 and lxml are cached apart, lxml may drift from bs4 (--verify-parser)
+        h = hashlib.sha1()
+        h.update('{}\0{}\0{}\0{}\0'.format(Exporter.extractor_version, item_type, url, parser).encode('utf-8'))
+        h.update(html.encode('utf-8'))
+        if item_type == 'radical':
+            slug = url[len('/radicals/'):]
+            if store.has_radical_image(slug):
+                # the record holds the prepared svg
+                h.update('\0{}\0'.format(prepare_version).encode('utf-8'))
+                h.update(store.load_radical_image(slug).encode('utf-8'))
+        return h.hexdigest()
+
+    def verify_parser(self, parser):
+        # Extract every stored page with both the reference bs4 path and the given parser, and report differences.
+        tasks = []
+        for item_type, item_list in self.selected_lists():
             for url in item_list:
-                queue.append((self.store, item_type, url))
+                tasks.append((item_type, url))
 
-        results = []
-        total = sum(len(i[1]) for i in item_lists)
-        with Pool(cpu_count() * 2) as pool:
-            for i, result in enumerate(pool.imap(self.extract_from_page, queue, 2)):
-                dump_progress(i, total, 'Extracting data from pages')
-                results.append(result)
-
-        self.write_to_csv(results)
-
-    def write_to_csv(self, results):
-        # 'subject': subject,
-        # 'level': level,
-        # 'item_type': text_item_type,
-        # 'part_of_speech': part_of_speech,
-        # 'primary_meaning': primary_meaning,
-        # 'additional_meanings': additional_meanings,
-        # 'primary_reading': primary_reading,
-        # 'additional_readings': additional_readings,
-        # 'on_reading': on_reading,
-        # 'on_muted': on_muted,
-        # 'kun_reading': kun_reading,
-        # 'kun_muted': kun_muted,
-        # 'nanori_reading': nanori_reading,
-        # 'nanori_muted': nanori_muted,
-        # 'meaning': meaning,
-        # 'reading': reading,
-        # 'context_sentences': context_sentences,
-        # 'audio_path': audio_path,
-        # 'link': link
+        mismatches = []
+        for i, mismatch in enumerate(self.map_pages(compare_parsers_in_worker, tasks, parser)):
+            dump_progress(i, len(tasks), 'Verifying ' + parser + ' parser')
+            if mismatch:
+                mismatches.append(mismatch)
+        print('')
 
-        def add_mute(value):
-            return '<span class="reading-muted">' + value + '</span>'
+        for url, keys in mismatches:
+            print('[mismatch] {} {}'.format(url, ', '.join(keys)))
+        print('{} of {} pages differ between bs4 and {}'.format(len(mismatches), len(tasks), parser))
+        return mismatches
+
+    def validate_pages(self, max_failures=20):
+        # Checks every stored page for the markup the extraction relies on (see wanianki.validate), in the pool,
+        # and stops after max_failures failing pages. Returns check name -> item type -> number of failing pages.
+        # The types take turns, so a type whose markup changed shows up within its first pages.
+        lists = [[(item_type, url) for url in item_list] for item_type, item_list in self.selected_lists()]
+        tasks = [task for turn in zip_longest(*lists) for task in turn if task]
+
+        broken = {}
+        examples = {}
+        failed = 0
+        checked = 0
+        results = self.map_pages(validate_in_worker, tasks)
+        try:
+            for (item_type, url), names in zip(tasks, results):
+                dump_progress(checked, len(tasks), 'Validating pages')
+                checked += 1
+                if not names:
+                    continue
+                failed += 1
+                for name in names:
+                    counts = broken.setdefault(name, {})
+                    counts[item_type] = counts.get(item_type, 0) + 1
+                    examples.setdefault((name, item_type), url)
+                if failed >= max_failures:
+                    break
+        finally:
+            # ends the pool early if we stopped early
+            results.close()
+        print('')
 
-        formatted_results = []
+        if failed >= max_failures and checked < len(tasks):
+            print('[validate] stopped after {} failing pages, {} of {} pages checked'.format(
+                failed, checked, len(tasks)))
+        for name, counts in sorted(broken.items(), key=lambda i: -sum(i[1].values())):
+            by_type = ', '.join('{} {}'.format(item_type, count) for item_type, count in sorted(counts.items()))
+            print('[broken] {}: {} pages ({})'.format(name, sum(counts.values()), by_type))
+            for item_type in sorted(counts):
+                print('    {}: expected {}, e.g. {}'.format(
+                    item_type, describe_check(item_type, name), examples[(name, item_type)]))
+        print('{} of {} checked pages fail validation'.format(failed, checked))
+        return broken
 
-        # noinspection PyUnreachableCode
-        if False:
-            formatted_results.append((
-                0, 'Sort field', 'Subject', 'Level', 'Item type', 'Primary meaning', 'Additional meanings',
-                'Part of speech', 'Primary reading', 'Additional readings',
-                'Onyomi reading', 'Kunyomi reading', 'Nanori reading',
-                'Meaning mnemonic', 'Reading mnemonic', 'Context sentences', 'Audio', 'WaniKani link'
-            ))
-
-        for result in results:
-            row = []
-
-            order = 1_000_000 * result['level']
-            item_type = result['item_type']
-            if item_type == 'Kanji':
-                order += 330_000
-            elif item_type == 'Vocabulary':
-                order += 660_000
-            row.append(order)
-
-            if item_type == 'Radical':
-                sort_field_type = '1 r'
-                sort_field_value = result['radical_slug']
-            elif item_type == 'Kanji':
-                sort_field_type = '2 k'
-                sort_field_value = result['subject']
-            elif item_type == 'Vocabulary':
-                sort_field_type = '3 v'
-                sort_field_value = result['subject']
-
-            sort_field = '{0:02d} {1} {2}'.format(result['level'], sort_field_type, sort_field_value)
-
-            row.append(sort_field)
-            row.append(result['subject'])
-            row.append(result['level'])
-            row.append(result['item_type'])
-            row.append(result['primary_meaning'])
-            row.append(result['additional_meanings'])
-            row.append(result['part_of_speech'])
-            row.append(result['primary_reading'])
-            row.append(result['additional_readings'])
-
-            onyomi_reading = result['on_reading']
-            if onyomi_reading and result['on_muted']:
-                onyomi_reading = add_mute(onyomi_reading)
-            row.append(onyomi_reading)
-
-            kunyomi_reading = result['kun_reading']
-            if kunyomi_reading and result['kun_muted']:
-                kunyomi_reading = add_mute(kunyomi_reading)
-            row.append(kunyomi_reading)
-
-            nanori_reading = result['nanori_reading']
-            if nanori_reading and result['nanori_muted']:
-                nanori_reading = add_mute(nanori_reading)
-            row.append(nanori_reading)
-
-            row.append(result['meaning'])
-            row.append(result['reading'])
-            row.append(result['context_sentences'])
-            audio = result['audio_path']
-            if audio:
-                row.append('[sound:{}]'.format(audio))
-            else:
-                row.append('')
-            row.append(result['link'])
+    @staticmethod
+    def compare_parsers(args):
+        store, item_type, url, parser = args
+        expected = Exporter.extract(store, item_type, url, 'bs4')
+        actual = Exporter.extract(store, item_type, url, parser)
+        keys = expected.differences(actual)
+        return (url, keys) if keys else None
 
-            formatted_results.append(row)
+    @staticmethod
+    def extract(store, item_type, url, parser='bs4', html=None):
+        if html is None:
+            html = store.load_page(url[1:])
 
-        formatted_results = sorted(formatted_results, key=lambda i: i[0])
-        formatted_results = map(lambda i: i[1:], formatted_results)
+        if parser == 'lxml':
+            from wanianki import lxml_extractor
+            return lxml_extractor.extract(store, item_type, url, html)
 
-        with open(self.store.get_output_path(), 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerows(formatted_results)
+        from bs4 import BeautifulSoup
 
-    # multiprocess-safe (does call a few store methods, but those are also multiprocess-safe).
-    @staticmethod
-    def extract_from_page(args):
         # extract data from the page, given the item type (radical, kanji or vocab)
-        store, item_type, url = args
-
-        html = store.load_page(url[1:])
         page = BeautifulSoup(html, 'html.parser')
         link = 'https://www.wanikani.com/' + url[1:]
 
@@ -249,12 +460,12 @@ class Exporter:
         level = int(page.select_one(pf + 'header h1 a.level-icon').text)
 
         radical_slug = ''
+        radical_image = ''
         if item_type == 'radical':
             radical_slug = link[len('https://www.wanikani.com/radicals/'):]
             radical_is_svg = store.has_radical_image(radical_slug)
             if radical_is_svg:
-                subject = store.load_radical_image(radical_slug)
-                subject = subject.replace('><defs', ' style="width: 1em; height: 1em;"><defs')
+                radical_image, subject = prepared_radical_image(store, radical_slug)
             else:
                 subject = page.select_one(pf + 'header h1 .' + icon_type + '-icon').text
         else:
@@ -283,22 +494,24 @@ class Exporter:
         kun_muted = False
         nanori_muted = False
 
+        sections = page.select(pf + 'section')
+
         if item_type == 'kanji':
-            readings = page.select(pf + 'section')[3]
-            on_reading = readings.select('.span4')[0].select_one('p').text.strip()
+            readings = sections[3].select('.span4')
+            on_reading = readings[0].select_one('p').text.strip()
             if on_reading == 'None':
                 on_reading = ''
-            on_muted = 'muted-content' in readings.select('.span4')[0]['class']
+            on_muted = 'muted-content' in readings[0]['class']
 
-            kun_reading = readings.select('.span4')[1].select_one('p').text.strip()
+            kun_reading = readings[1].select_one('p').text.strip()
             if kun_reading == 'None':
                 kun_reading = ''
-            kun_muted = 'muted-content' in readings.select('.span4')[1]['class']
+            kun_muted = 'muted-content' in readings[1]['class']
 
-            nanori_reading = readings.select('.span4')[2].select_one('p').text.strip()
+            nanori_reading = readings[2].select_one('p').text.strip()
             if nanori_reading == 'None':
                 nanori_reading = ''
-            nanori_muted = 'muted-content' in readings.select('.span4')[2]['class']
+            nanori_muted = 'muted-content' in readings[2]['class']
 
         # Meaning and reading mnemonic with html filtering
         def filter_mnemonic(el):
@@ -325,10 +538,10 @@ class Exporter:
 
             return '<br>\n<br>\n'.join(mnemonic_parts)
 
-        meaning = filter_mnemonic(page.select(pf + 'section')[2 if item_type == 'radical' else 4])
+        meaning = filter_mnemonic(sections[2 if item_type == 'radical' else 4])
         reading = ''
         if item_type == 'kanji' or item_type == 'vocab':
-            reading = filter_mnemonic(page.select(pf + 'section')[6])
+            reading = filter_mnemonic(sections[6])
 
         # Vocab only: context sentences
         context_sentences = ''
@@ -342,8 +555,10 @@ class Exporter:
 
         # Vocab only: audio
         audio_path = ''
+        audio_url = ''
         if item_type == 'vocab':
             audio_path = 'wanikani_vocab_audio_' + quote(subject) + '.mp3'
+            audio_url = page.select_one('.vocabulary-reading audio source[type="audio/mpeg"]')['src']
 
         if item_type == 'radical':
             text_item_type = 'Radical'
@@ -375,188 +590,564 @@ class Exporter:
             print('reading "{}"'.format(reading))
             print('context sentences "{}"'.format(context_sentences))
             print('audio path "{}"'.format(audio_path))
+            print('audio url "{}"'.format(audio_url))
             print('link "{}"'.format(link))
 
-        return {
-            'subject': subject,
-            'level': level,
-            'item_type': text_item_type,
-            'part_of_speech': part_of_speech,
-            'primary_meaning': primary_meaning,
-            'additional_meanings': additional_meanings,
-            'primary_reading': primary_reading,
-            'additional_readings': additional_readings,
-            'on_reading': on_reading,
-            'on_muted': on_muted,
-            'kun_reading': kun_reading,
-            'kun_muted': kun_muted,
-            'nanori_reading': nanori_reading,
-            'nanori_muted': nanori_muted,
-            'meaning': meaning,
-            'reading': reading,
-            'context_sentences': context_sentences,
-            'audio_path': audio_path,
-            'radical_slug': radical_slug,
-            'link': link
-        }
+        return ItemRecord(
+            subject=subject,
+            level=level,
+            item_type=text_item_type,
+            part_of_speech=part_of_speech,
+            primary_meaning=primary_meaning,
+            additional_meanings=additional_meanings,
+            primary_reading=primary_reading,
+            additional_readings=additional_readings,
+            on_reading=on_reading,
+            on_muted=on_muted,
+            kun_reading=kun_reading,
+            kun_muted=kun_muted,
+            nanori_reading=nanori_reading,
+            nanori_muted=nanori_muted,
+            meaning=meaning,
+            reading=reading,
+            context_sentences=context_sentences,
+            audio_path=audio_path,
+            audio_url=audio_url,
+            radical_slug=radical_slug,
+            radical_image=radical_image,
+            link=link
+        )
+
+
+# Per-process state of the extraction pool, set once by init_extraction_worker.
+extraction_worker = {}
+
+
+def init_extraction_worker(store, parser, instrumentation=None, svg_media=False):
+    store.after_fork()
+    extraction_worker['store'] = store
+    extraction_worker['parser'] = parser
+    extraction_worker['svg_media'] = svg_media
+    if instrumentation:
+        init_worker(*instrumentation)
+
+
+def extract_row_in_worker(task):
+    item_type, url = task
+    return Exporter.extract_row((extraction_worker['store'], item_type, url, extraction_worker['parser']),
+                                extraction_worker['svg_media'])
+
+
+def extract_in_worker(task):
+    item_type, url = task
+    Exporter.extract_from_page((extraction_worker['store'], item_type, url, extraction_worker['parser']))
+
+
+def validate_in_worker(task):
+    item_type, url = task
+    store = extraction_worker['store']
+    html = store.load_page(url[1:]) if store.has_page(url[1:]) else None
+    has_svg = item_type == 'radical' and store.has_radical_image(url[len('/radicals/'):])
+    return broken_checks(html, item_type, extraction_worker['parser'], has_svg)
+
+
+def compare_parsers_in_worker(task):
+    item_type, url = task
+    return Exporter.compare_parsers((extraction_worker['store'], item_type, url, extraction_worker['parser']))
 
 
 class Importer:
-    def __init__(self, store: Store, key: str, session_cookie: str):
+    def __init__(self, store: Store, key: str, session_cookie: str,
+                 concurrency=1, rate_limits=None, max_retries=5, pool_size=None, timeout=(10, 60),
+                 backend='threads', audio_concurrency=8, incremental=False, parser='bs4', selection=None,
+                 job_attempts=3, job_backoff=5.0, concurrent_paging=True):
         self.store = store
+        self.parser = parser
+        # Levels and item types to crawl, and the document paths of the selected subjects once they're known.
+        self.selection = selection or Selection()
+        self.selected_paths = None
+        # SubjectIndex over the subjects cache, built once the subjects are up to date
+        self.index = None
         self.key = key
         self.session_cookie = session_cookie
 
         self.root = 'https://api.wanikani.com/v2'
+        self.site = 'https://www.wanikani.com'
 
         self.loop = asyncio.get_event_loop()
-        self.executor = ThreadPoolExecutor()
-        self.last_request_time = None
-        self.rate_limiting_delay = 1.1
+        self.concurrency = concurrency
+        # Audio comes from a CDN without the page rate limit, so it gets its own, larger bound.
+        self.audio_concurrency = audio_concurrency
+        # One connection per worker thread, so a thread never waits on the pool for a free connection.
+        self.pool_size = pool_size or max(concurrency, audio_concurrency, 4)
+        self.executor = ThreadPoolExecutor(self.pool_size)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.sessions = {}
+
+        # 'aiohttp' runs every request as a coroutine on the loop, 'threads' wraps requests in the executor.
+        self.transport = None
+        if backend == 'aiohttp':
+            if has_aiohttp():
+                self.transport = AiohttpTransport(self.headers_for, self.pool_size, timeout)
+            else:
+                print('[aiohttp not installed, falling back to the thread pool]')
 
-    def run(self):
-        self.loop.run_until_complete(self.start())
+        # host -> (requests per second, burst size). Hosts not listed use the 'default' entry.
+        self.rate_limits = {
+            'api.wanikani.com': (1 / 1.1, 1),
+            'www.wanikani.com': (1 / 1.1, 1),
+            'default': (1 / 1.1, 1),
+        }
+        if rate_limits:
+            self.rate_limits.update(rate_limits)
+        self.limiters = {}
+
+        # Incremental sync: only subjects updated since the last sync are refreshed, with conditional GETs.
+        self.incremental = incremental
+        self.manifest = store.load_sync_manifest()
+        self.changed_vocab = []
+        self.changed_radicals = set()
+        # Fetch the pages of an api collection concurrently after the first one, see request_paged.
+        self.concurrent_paging = concurrent_paging
+
+        # Which svgs, pages and mp3s are done, so a resumed crawl goes straight to what is left.
+        # Items that fail are tried job_attempts times, job_backoff seconds apart and doubling, see crawl.
+        self.ledger = JobLedger(store.dir('jobs.log'))
+        self.job_attempts = job_attempts
+        self.job_backoff = job_backoff
+        self.failures = []
+
+        # Called with (item type, position in the lattice list, url) for every page that is on disk,
+        # used by Exporter.run_pipelined to extract while the crawl is still running.
+        self.page_sink = None
+
+    def run(self, main=None):
+        try:
+            self.loop.run_until_complete(main or self.start())
+        finally:
+            self.store.flush()
+            self.ledger.close()
+            for host, limiter in self.limiters.items():
+                metrics.add('limiter_sleep_seconds.' + host, limiter.sleeping)
+            if self.transport:
+                self.loop.run_until_complete(self.transport.close())
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
 
     async def start(self):
-        if not self.store.has_all_subjects():
-            all_subjects = await self.request_paged('/subjects')
-            self.store.store_all_subjects(all_subjects)
+        stored_selection = Selection.from_json(self.manifest.get('subjects_selection'))
+        if not self.store.has_all_subjects() or not stored_selection.covers(self.selection):
+            # every page of subjects goes to disk as it arrives
+            with self.store.subjects_writer() as writer:
+                await self.request_paged('/subjects', self.selection.api_filters() or None, writer.add_collection)
+            self.manifest['subjects_updated_at'] = writer.updated_at
+            self.manifest['subjects_selection'] = self.selection.to_json()
+            self.store.store_sync_manifest(self.manifest)
+            changed, updated_at = [], None
+        elif self.incremental:
+            changed, updated_at = await self.sync_subjects()
+        else:
+            changed, updated_at = [], None
 
-        if not self.store.has_lattice_list('radicals'):
-            await self.get_lattice('https://www.wanikani.com/lattice/radicals/meaning', 'radicals')
+        self.index = SubjectIndex.from_store(self.store)
+        if not self.selection.is_all():
+            self.selected_paths = self.index.paths(self.selection)
 
-        if not self.store.has_lattice_list('kanji'):
-            await self.get_lattice('https://www.wanikani.com/lattice/kanji/combined', 'kanji')
+        for item_type, (api_type, name) in item_types.items():
+            if self.selection.has_type(item_type):
+                self.update_page_list(api_type, name)
 
-        if not self.store.has_lattice_list('vocabulary'):
-            await self.get_lattice('https://www.wanikani.com/lattice/vocabulary/combined', 'vocabulary')
+        if changed:
+            await self.refresh_changed(changed)
 
-        radical_urls = self.store.get_lattice_list('radicals')
-        for i, radical_url in enumerate(radical_urls):
-            dump_progress(i, len(radical_urls), 'Downloading radicals\'s')
-            if not self.store.has_page(radical_url[1:]):
-                page = await self.request_site('https://www.wanikani.com' + radical_url)
-                self.store.store_page(page, radical_url[1:])
+        # radical svgs first, the extraction of a radical page needs its svg
+        await self.collect_image_radicals()
+        self.store.flush()
+
+        if self.selection.has_type('radical'):
+            await self.download_pages(self.selected_urls('radicals'), 'radical', 'Downloading radicals\'s')
+        if self.selection.has_type('kanji'):
+            await self.download_pages(self.selected_urls('kanji'), 'kanji', 'Downloading kanji\'s')
+        if self.selection.has_type('vocab'):
+            await self.download_pages(self.selected_urls('vocabulary'), 'vocab', 'Downloading vocabulary')
+
+        # the audio urls are read from the vocabulary pages, they all have to be there
+        if not self.failures:
+            await self.collect_audio()
+
+        if self.failures:
+            raise CrawlIncomplete(self.failures)
+
+        # Only move the sync cursor once everything that changed has been refreshed.
+        if updated_at:
+            self.manifest['subjects_updated_at'] = updated_at
+        self.store.store_sync_manifest(self.manifest)
+
+    def update_page_list(self, api_type, name):
+        # The pages to crawl, from the subjects. Lists from earlier crawls keep the spelling of their urls.
+        previous = self.store.get_lattice_list(name) if self.store.has_lattice_list(name) else None
+        urls = self.index.urls(api_type, previous)
+        if urls != previous:
+            self.store.store_lattice_list(name, urls)
+
+    def selected_urls(self, name):
+        return self.selection.filter_urls(self.store.get_lattice_list(name), self.selected_paths)
+
+    async def sync_subjects(self):
+        # Fetch the subjects updated since the last sync and append them to the subjects cache.
+        since = self.manifest.get('subjects_updated_at') or self.store.subjects_updated_at()
+        if not since:
+            return [], None
+
+        # same levels and types as the stored subjects were fetched with
+        filters = Selection.from_json(self.manifest.get('subjects_selection')).api_filters()
+        filters['updated_after'] = since
+
+        changed = []
+        with self.store.subjects_writer(append=True) as writer:
+            def add_collection(collection):
+                writer.add_collection(collection)
+                changed.extend(collection['data'])
+
+            await self.request_paged('/subjects', filters, add_collection)
+        print('[sync] {} subjects updated after {}'.format(len(changed), since))
+
+        return changed, writer.updated_at or since
+
+    async def refresh_changed(self, changed):
+        to_refresh = []
+        for item_type, (api_type, name) in item_types.items():
+            if not self.selection.has_type(item_type):
+                continue
+
+            # The page lists already include new subjects, reuse their spelling of the url, it's the page's key.
+            by_path = {unquote(url): url for url in self.store.get_lattice_list(name)}
+            for item in changed:
+                if item['object'] != api_type or not self.selection.matches(item['object'], item['data']['level']):
+                    continue
+
+                url = by_path.get(unquote(urlparse(item['data']['document_url']).path))
+                if url is None:
+                    # hidden subject
+                    continue
+
+                to_refresh.append(url)
+                if name == 'vocabulary':
+                    self.changed_vocab.append(url)
+                elif name == 'radicals':
+                    self.changed_radicals.add(item['data']['slug'])
+
+        async def refresh(url):
+            page = await self.request_site_conditional(self.site + url, self.store.has_page(url[1:]))
+            if page is not None:
+                self.store.store_page(page, url[1:])
+
+        await self.crawl(to_refresh, refresh, 'Refreshing changed pages')
+        self.store.store_sync_manifest(self.manifest)
+
+    async def download_pages(self, urls, item_type, subject):
+        async def download(position_and_url):
+            position, url = position_and_url
+            page = await self.request_site_conditional(self.site + url, stored=False)
+            self.store.store_page(page, url[1:])
+            await sink(position_and_url)
+
+        async def sink(position_and_url):
+            if self.page_sink:
+                position, url = position_and_url
+                await self.page_sink(item_type, position, url)
+
+        await self.crawl(list(enumerate(urls)), download, subject, stage='page', job=lambda item: item[1],
+                         exists=lambda item: self.store.has_page(item[1][1:]), skip=sink)
+        self.store.store_sync_manifest(self.manifest)
+
+    async def crawl(self, items, fn, subject, concurrency=None, stage=None, job=None, exists=None, skip=None):
+        # Run fn over all items with at most `concurrency` of them in flight.
+        # The limiters in request_thing decide how fast requests actually go out.
+        #
+        # An item that fails is tried again after a backoff, up to job_attempts times, without stopping the others.
+        # What still fails is collected in self.failures, start() reports it once everything else is done.
+        # With a `stage`, the items are jobs in the ledger named by job(item): jobs that are done are not run again
+        # (skip(item) is called instead), `exists(item)` tells whether a job unknown to the ledger is done already.
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+        done = 0
+        if stage and exists and self.store.locks is not None:
+            fn = self.claimed(fn, stage, job, exists, skip)
+
+        async def worker(item):
+            nonlocal done
+            name = job(item) if stage else None
+            if stage and self.ledger.is_done(stage, name, exists and (lambda: exists(item))):
+                if skip:
+                    await skip(item)
+            else:
+                if stage:
+                    self.ledger.mark_pending(stage, name)
+                await self.attempt(item, fn, semaphore, stage, name)
+            dump_progress(done, len(items), subject)
+            done += 1
+
+        if items:
+            await asyncio.gather(*[worker(item) for item in items])
         print('')
 
-        kanji_urls = self.store.get_lattice_list('kanji')
-        for i, kanji_url in enumerate(kanji_urls):
-            dump_progress(i, len(kanji_urls), 'Downloading kanji\'s')
-            if not self.store.has_page(kanji_url[1:]):
-                page = await self.request_site('https://www.wanikani.com' + kanji_url)
-                self.store.store_page(page, kanji_url[1:])
-        print('')
+    def claimed(self, fn, stage, job, exists, skip):
+        # With a shared cache another run may be fetching the same item. Its lock is held while it's fetched, and
+        # whichever run gets the lock second finds the item in the cache.
+        async def run(item):
+            async with self.store.locks.hold(stage + '/' + job(item)):
+                if exists(item):
+                    metrics.add('shared_cache.' + stage)
+                    if skip:
+                        await skip(item)
+                    return
+                await fn(item)
+        return run
+
+    async def attempt(self, item, fn, semaphore, stage, name):
+        for attempt in range(self.job_attempts):
+            if attempt:
+                # back off outside the semaphore, the other items keep going meanwhile
+                await asyncio.sleep(min(self.job_backoff * 2 ** (attempt - 1), 300))
+            try:
+                async with semaphore:
+                    await fn(item)
+            except Exception as e:
+                if stage:
+                    self.ledger.mark_failed(stage, name, e)
+                error = e
+                continue
+
+            if stage:
+                # only once what the job wrote can't be lost anymore, or a crash would leave it done but missing
+                self.store.when_committed(lambda: self.ledger.mark_done(stage, name))
+            return
+
+        self.failures.append((stage, name if stage else item, error))
 
-        vocab_urls = self.store.get_lattice_list('vocabulary')
-        for i, vocab_url in enumerate(vocab_urls):
-            dump_progress(i, len(vocab_urls), 'Downloading vocabulary')
-            if not self.store.has_page(vocab_url[1:]):
-                page = await self.request_site('https://www.wanikani.com' + vocab_url)
-                self.store.store_page(page, vocab_url[1:])
-        print('')
+    async def collect_audio(self):
+        if not self.selection.has_type('vocab'):
+            return
 
-        await self.collect_image_radicals()
-        await self.collect_audio()
+        if not self.selection.is_all():
+            # partial crawl: the audio list of just the selected vocab, not stored as the audio list
+            audio_list = [self.audio_for_page(vocab) for vocab in self.selected_urls('vocabulary')]
+        else:
+            audio_list = await self.collect_audio_list()
 
-    async def collect_audio(self):
+        async def download(audio):
+            subject, mp3src = audio
+            audio_path = self.store.get_audio_path(subject)
+            await self.request_thing(ThingRequest.for_file(mp3src, audio_path))
+
+        await self.crawl(audio_list, download, 'Downloading mp3\'s', self.audio_concurrency, stage='audio',
+                         job=lambda audio: audio[0], exists=lambda audio: self.store.has_audio(audio[0]))
+
+    async def collect_audio_list(self):
         vocab_list = self.store.get_lattice_list('vocabulary')
 
         if not self.store.has_audio_list():
             audios = []
             for i, vocab in enumerate(vocab_list):
                 dump_progress(i, len(vocab_list), 'Collecting audio urls')
-                html = self.store.load_page(vocab[1:])
-                page = BeautifulSoup(html, 'html.parser')
-                mp3src = page.select_one('.vocabulary-reading audio source[type=audio/mpeg]')['src']
-                subject_name = re.search(r'audio/\d+-([^.]+)', mp3src).group(1)
-                subject = 'wanikani_vocab_audio_' + subject_name
-
-                audios.append((subject, mp3src))
+                audios.append(self.audio_for_page(vocab))
 
             self.store.store_audio_list(audios)
 
             print('')
+        elif self.changed_vocab:
+            audios = self.store.load_audio_list()
+            known = set(subject for subject, mp3src in audios)
+            for vocab in self.changed_vocab:
+                subject, mp3src = self.audio_for_page(vocab)
+                if subject not in known:
+                    audios.append((subject, mp3src))
+                    known.add(subject)
 
-        audio_list = self.store.load_audio_list()
-        for i, audio in enumerate(audio_list):
-            dump_progress(i, len(audio_list), 'Downloading mp3\'s')
-            subject, mp3src = audio
+            self.store.store_audio_list(audios)
 
-            if not self.store.has_audio(subject):
-                audio_path = self.store.get_audio_path(subject)
-                await self.request_thing(ThingRequest.for_file(mp3src, audio_path))
+        return self.store.load_audio_list()
 
-        print('')
+    def audio_for_page(self, vocab):
+        mp3src = Exporter.extract_from_page((self.store, 'vocab', vocab, self.parser)).audio_url
+        subject_name = re.search(r'audio/\d+-([^.]+)', mp3src).group(1)
+        subject = 'wanikani_vocab_audio_' + subject_name
+
+        return subject, mp3src
 
     async def collect_image_radicals(self):
-        image_radicals = []
-
-        subject_pages = self.store.get_all_subjects()
-        for collection in subject_pages:
-            for item in collection['data']:
-                if item['object'] == 'radical':  # and not item['data']['characters']:
-                    slug = item['data']['slug']
-                    csssvg = list(filter(lambda j: j['metadata'].get('inline_styles'),
-                                         item['data']['character_images']))[0]['url']
-                    image_radicals.append((slug, csssvg))
-
-        for i, image_radical in enumerate(image_radicals):
-            dump_progress(i, len(image_radicals), 'Downloading radical svg\'s')
+        image_radicals = self.index.image_radicals(self.selection)
+
+        async def download(image_radical):
             slug, url = image_radical
-            if not self.store.has_radical_image(slug):
-                svg_content = await self.request_site(url)
+            svg_content = await self.request_site_conditional(url, stored=False)
+            self.store.store_radical_image(svg_content, slug)
 
+        async def refresh(image_radical):
+            slug, url = image_radical
+            svg_content = await self.request_site_conditional(url)
+            if svg_content is not None:
                 self.store.store_radical_image(svg_content, slug)
-        print('')
 
-    async def get_lattice(self, url, name):
-        html = await self.request_site(url)
-        soup = BeautifulSoup(html, 'html.parser')
-        container = soup.select_one('.lattice-multi-character' if name == 'vocabulary' else '.lattice-single-character')
+        await self.crawl(image_radicals, download, 'Downloading radical svg\'s', stage='svg',
+                         job=lambda image_radical: image_radical[0],
+                         exists=lambda image_radical: self.store.has_radical_image(image_radical[0]))
+
+        changed = [image_radical for image_radical in image_radicals if image_radical[0] in self.changed_radicals]
+        if changed:
+            await self.crawl(changed, refresh, 'Refreshing changed radical svg\'s')
 
-        urls = []
-        for link in container.select('li a'):
-            urls.append(link.get('href'))
-        self.store.store_lattice_list(name, urls)
+        prepare_radical_images(self.store, [slug for slug, url in image_radicals])
 
-    async def request_paged(self, endpoint, filters=None):
+    async def request_paged(self, endpoint, filters=None, sink=None):
+        # With a sink, every page is handed to it as it arrives instead of being collected and returned.
+        # With concurrent paging the pages after the first one arrive in no particular order.
         pages = []
 
+        def collect(result):
+            if sink:
+                sink(result)
+            else:
+                pages.append(result)
+
         result = await self.request(endpoint, filters)
+        collect(result)
+        if not next_page_after(result):
+            return pages
 
-        while True:
-            pages.append(result)
+        if not self.concurrent_paging:
+            await self.follow_pages(endpoint, filters, result['data'][-1]['id'], None, collect)
+            return pages
 
-            next_endpoint = None
-            if 'pages' in result:
-                pages_result = result['pages']
-                if 'next_url' in pages_result and pages_result['next_url']:
-                    next_endpoint = pages_result['next_url'][len(self.root):]
+        semaphore = asyncio.Semaphore(self.concurrency)
 
-            if next_endpoint:
-                result = await self.request(next_endpoint, filters)
-            else:
-                break
+        async def follow(after_id, until_id):
+            async with semaphore:
+                await self.follow_pages(endpoint, filters, after_id, until_id, collect)
 
+        await asyncio.gather(*(follow(after_id, until_id) for after_id, until_id in cursor_ranges(result)))
         return pages
 
+    async def follow_pages(self, endpoint, filters, after_id, until_id, collect):
+        # Pages of the subjects with after_id < id <= until_id (no upper bound if until_id is None),
+        # following the page_after_id cursor.
+        while True:
+            result = await self.request(endpoint, dict(filters or {}, page_after_id=after_id))
+            data = result['data']
+            if until_id is not None and data and data[-1]['id'] > until_id:
+                result = dict(result, data=[item for item in data if item['id'] <= until_id])
+            if result['data']:
+                collect(result)
+
+            if not next_page_after(result) or (until_id is not None and data and data[-1]['id'] >= until_id):
+                return
+            after_id = data[-1]['id']
+
     async def request(self, endpoint, filters=None):
         return await self.request_thing(ThingRequest.for_api(endpoint, filters))
 
-    async def request_site(self, url):
-        return await self.request_thing(ThingRequest.for_site(url))
+    async def request_site_conditional(self, url, stored=True):
+        # Returns None if the server says the page didn't change since the validators we stored for it.
+        # Without a stored copy (stored=False) the request is unconditional, but the validators are still recorded.
+        validators = self.manifest['validators'].get(url) if stored else None
+        text, new_validators = await self.request_thing(ThingRequest.for_site(url, validators))
+        if new_validators:
+            self.manifest['validators'][url] = new_validators
+        return text
+
+    def headers_for(self, api):
+        if api:
+            return {'Authorization': 'Bearer {}'.format(self.key)}
+        return {
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.13; rv:60.0) Gecko/20100101 Firefox/60.0',
+            'Cookie': '_wanikani_session=' + self.session_cookie
+        }
+
+    def session_for(self, host, api):
+        # Keep-alive session per host, created on the event loop thread and shared by the worker threads.
+        if host not in self.sessions:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(self.headers_for(api))
+            self.sessions[host] = session
+        return self.sessions[host]
+
+    def limiter_for(self, host):
+        if host not in self.limiters:
+            rate, capacity = self.rate_limits.get(host, self.rate_limits['default'])
+            self.limiters[host] = TokenBucket(rate, capacity)
+        return self.limiters[host]
 
     async def request_thing(self, api_request: 'ThingRequest'):
         skip_cooldown = api_request.type == ThingRequest.TYPE_FILE
+        host = urlparse(self.root if api_request.type == ThingRequest.TYPE_API else api_request.url).hostname
+        limiter = self.limiter_for(host)
+
+        fetch = self.fetch_native if self.transport else self.fetch_threaded
+        last_error = None
+
+        kind = ThingRequest.kinds[api_request.type]
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.add('retries.' + kind)
+
+            if not skip_cooldown:
+                with metrics.time('limiter.' + host):
+                    await limiter.acquire()
+
+            try:
+                with metrics.time('request.' + kind):
+                    result = await fetch(api_request, host)
+            except RateLimited as e:
+                last_error = e
+                metrics.add('rate_limited.' + host)
+                # print('[rate limited] {} retry after {}s'.format(host, e.retry_after))
+                limiter.backoff(e.retry_after)
+                if skip_cooldown:
+                    with metrics.time('limiter.' + host):
+                        await limiter.acquire()
+                continue
+            except IncompleteDownload as e:
+                # Keep the partial file, the next attempt resumes it.
+                last_error = e
+                metrics.add('incomplete.' + kind)
+                continue
+
+            limiter.recover()
+            return result
+
+        metrics.add('failed.' + kind)
+        raise Exception(('Request failed', host, api_request.endpoint or api_request.url, last_error))
+
+    async def fetch_native(self, api_request: 'ThingRequest', host):
+        if api_request.type == ThingRequest.TYPE_API:
+            response_json = await self.transport.get_json(
+                host, self.root + api_request.endpoint, api_request.filters or {})
+
+            if 'error' in response_json:
+                print('[*** api error] {}'.format(response_json['error']))
+                return None
+
+            return response_json
+        elif api_request.type == ThingRequest.TYPE_SITE:
+            return await self.transport.get_text(host, api_request.url, api_request.validators)
+        elif api_request.type == ThingRequest.TYPE_FILE:
+            await self.transport.download(host, api_request.url, api_request.path)
+        else:
+            raise ValueError()
 
-        if not skip_cooldown and self.last_request_time is not None:
-            now = time()
-            if now < self.last_request_time + self.rate_limiting_delay:
-                to_sleep = self.last_request_time + self.rate_limiting_delay - now
-                # print('[rate limiting] sleep for {}s'.format(to_sleep))
-                await asyncio.sleep(to_sleep)
+    async def fetch_threaded(self, api_request: 'ThingRequest', host):
+        import requests
 
-        self.last_request_time = time()
+        session = self.session_for(host, api_request.type == ThingRequest.TYPE_API)
 
         if api_request.type == ThingRequest.TYPE_API:
             endpoint = api_request.endpoint
@@ -567,9 +1158,9 @@ class Importer:
             def run():
                 url = self.root + endpoint
                 # print('[api] {}'.format(url))
-                response = requests.get(url, headers={
-                    'Authorization': 'Bearer {}'.format(self.key)
-                }, params=filters)
+                response = session.get(url, params=filters, timeout=self.timeout)
+                observe_response('api', response)
+                check_rate_limited(response)
 
                 response_json = response.json()
 
@@ -578,26 +1169,54 @@ class Importer:
                     return None
 
                 return response_json
-        elif api_request.type == ThingRequest.TYPE_SITE or api_request.type == ThingRequest.TYPE_FILE:
-            site = api_request.type == ThingRequest.TYPE_SITE
-
+        elif api_request.type == ThingRequest.TYPE_SITE:
             def run():
                 url = api_request.url
-                # print('[{}] {}'.format('page' if site else 'file', url))
-                response = requests.get(url, headers={
-                    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.13; rv:60.0) Gecko/20100101 Firefox/60.0',
-                    'Cookie': '_wanikani_session=' + self.session_cookie
-                }, stream=not site)
-                if site:
-                    return response.text
-                else:
-                    with open(api_request.path, 'wb') as f:
-                        shutil.copyfileobj(response.raw, f)
+                # print('[page] {}'.format(url))
+                response = session.get(url, timeout=self.timeout,
+                                       headers=conditional_headers(api_request.validators))
+                observe_response('site', response)
+                check_rate_limited(response)
+                if response.status_code == 304:
+                    return None, api_request.validators
+                if not response.ok:
+                    # not a page, the job fails and is retried instead of the error page being stored
+                    raise Exception(('Page request failed', response.status_code, url))
+                return response.text, response_validators(response.headers)
+        elif api_request.type == ThingRequest.TYPE_FILE:
+            def run():
+                url = api_request.url
+                filepath = api_request.path
+                # print('[file] {}'.format(url))
+                offset = resume_offset(filepath)
+                try:
+                    with session.get(url, stream=True, timeout=self.timeout, headers=range_headers(offset)) as response:
+                        metrics.observe('response_headers.file', response.elapsed.total_seconds())
+                        check_rate_limited(response)
+                        if response.status_code == 416:
+                            discard_partial(filepath)
+                            raise IncompleteDownload(('Range not satisfiable', url))
+
+                        append, total = expected_size(response.status_code, response.headers, offset)
+                        with open(partial_path(filepath), 'ab' if append else 'wb') as f:
+                            start = f.tell()
+                            shutil.copyfileobj(response.raw, f)
+                            metrics.add('bytes.file', f.tell() - start)
+                except requests.RequestException as e:
+                    raise IncompleteDownload((url, e))
+
+                finish_download(filepath, total)
         else:
             raise ValueError()
 
-        request_future = self.loop.run_in_executor(self.executor, run)
-        return await request_future
+        return await self.loop.run_in_executor(self.executor, run)
+
+
+class CrawlIncomplete(Exception):
+    # Some items still failed after all attempts. Running again retries just those.
+    def __init__(self, failures):
+        super().__init__('{} items failed, run again to retry them. First: {}'.format(len(failures), failures[0]))
+        self.failures = failures
 
 
 class ThingRequest:
@@ -605,12 +1224,16 @@ class ThingRequest:
     TYPE_SITE = 1
     TYPE_FILE = 2
 
+    # names in the metrics
+    kinds = {TYPE_API: 'api', TYPE_SITE: 'site', TYPE_FILE: 'file'}
+
     def __init__(self, thing_type):
         self.type = thing_type
         self.endpoint = None
         self.filters = None
         self.url = None
         self.path = None
+        self.validators = None
 
     @classmethod
     def for_api(cls, endpoint, filters=None):
@@ -620,9 +1243,10 @@ class ThingRequest:
         return t
 
     @classmethod
-    def for_site(cls, url):
+    def for_site(cls, url, validators=None):
         t = cls(ThingRequest.TYPE_SITE)
         t.url = url
+        t.validators = validators
         return t
 
     @classmethod
@@ -633,6 +1257,41 @@ class ThingRequest:
         return t
 
 
+def next_page_after(result):
+    return bool(result.get('data') and (result.get('pages') or {}).get('next_url'))
+
+
+def cursor_ranges(first):
+    # Splits what comes after the first page of a collection into (after id, until id) ranges of about one page
+    # each, to be fetched concurrently. The api pages by id, so the ranges are estimated from how densely the
+    # first page's ids are spread. A wrong guess only costs requests: a range with more subjects than a page
+    # takes several, an empty one a single one, and the last range is open ended.
+    data = first['data']
+    per_page = first['pages'].get('per_page') or len(data)
+    remaining = first.get('total_count', 0) - len(data)
+    first_id, last_id = data[0]['id'], data[-1]['id']
+
+    ids_per_subject = max((last_id - first_id + 1) / len(data), 1)
+    ids_per_page = max(int(per_page * ids_per_subject), 1)
+    count = max(-(-remaining // per_page), 1)
+
+    bounds = [last_id + i * ids_per_page for i in range(count)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def check_rate_limited(response):
+    # 429, or any other error response that tells us when to come back (e.g. 503 with Retry-After)
+    if response.status_code == 429 or (not response.ok and 'Retry-After' in response.headers):
+        response.close()
+        raise RateLimited(parse_retry_after(response.headers.get('Retry-After')))
+
+
+def observe_response(kind, response):
+    # elapsed is the time until the headers were parsed: connecting, TLS and the server's response time
+    metrics.observe('response_headers.' + kind, response.elapsed.total_seconds())
+    metrics.add('bytes.' + kind, len(response.content))
+
+
 def dump(data, message=None):
     pretty = json.dumps(data, indent=2, sort_keys=True)
     if message:
@@ -643,6 +1302,12 @@ def dump(data, message=None):
 
 def dump_progress(current, total, subject=None):
     current += 1
+    summary = metrics.progress(subject, current, total)
+    if summary is not None:
+        if summary:
+            print('\r' + summary.ljust(120), end='')
+        return
+
     percentage = round(100 * (current / total), 2)
     to_print = '{}/{} {}%'.format(current, total, percentage)
     if subject:
@@ -0,0 +1,98 @@
+import json
+from os import path, replace
+
+from wanianki.metrics import metrics
+
+
+class JobLedger:
+    # Persisted state of every crawl job, like ('page', '/kanji/%E4%B8%80') or ('audio', 'wanikani_vocab_audio_...').
+    # A job is pending, done or failed, with the number of attempts and the last error.
+    #
+    # The ledger is an append-only log of state changes, replayed on load. A crash can at most cut off the last
+    # line, which is ignored. The log is compacted when it has grown well beyond one line per job.
+    pending = 'pending'
+    done = 'done'
+    failed = 'failed'
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.jobs = {}
+        self.file = None
+
+        lines = 0
+        if path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.jobs[(entry['stage'], entry['job'])] = entry
+                    lines += 1
+
+        if lines > 2 * len(self.jobs) + 1000:
+            self.compact()
+
+    def compact(self):
+        self.close()
+        temporary = self.filepath + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            for entry in self.jobs.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        replace(temporary, self.filepath)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, entry):
+        if self.file is None:
+            self.file = open(self.filepath, 'a', encoding='utf-8')
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def get(self, stage, job):
+        return self.jobs.get((stage, job))
+
+    def set(self, stage, job, state, error=None, attempt=False):
+        entry = self.jobs.get((stage, job)) or {'stage': stage, 'job': job, 'state': None, 'attempts': 0}
+        if entry['state'] == state and not attempt:
+            return
+        entry = dict(entry, state=state)
+        if attempt:
+            entry['attempts'] += 1
+        if error is not None:
+            entry['error'] = str(error)
+        else:
+            entry.pop('error', None)
+        self.jobs[(stage, job)] = entry
+        self.write(entry)
+
+    def is_done(self, stage, job, exists=None):
+        # `exists` checks the store for jobs the ledger doesn't know yet, like files from a run before the ledger.
+        entry = self.jobs.get((stage, job))
+        if entry is None and exists is not None and exists():
+            self.set(stage, job, JobLedger.done)
+            return True
+        return entry is not None and entry['state'] == JobLedger.done
+
+    def mark_pending(self, stage, job):
+        if (stage, job) not in self.jobs:
+            self.set(stage, job, JobLedger.pending)
+
+    def mark_done(self, stage, job):
+        self.set(stage, job, JobLedger.done, attempt=True)
+        metrics.add('jobs_done.' + stage)
+
+    def mark_failed(self, stage, job, error):
+        self.set(stage, job, JobLedger.failed, error, attempt=True)
+        metrics.add('jobs_failed.' + stage)
+
+    def summary(self):
+        # stage -> state -> number of jobs
+        counts = {}
+        for (stage, job), entry in self.jobs.items():
+            states = counts.setdefault(stage, {})
+            states[entry['state']] = states.get(entry['state'], 0) + 1
+        return counts
@@ -0,0 +1,71 @@
+import hashlib
+from os import O_CREAT, O_RDWR, close, makedirs, open as open_fd, path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def has_locking():
+    return fcntl is not None
+
+
+class CacheLocks:
+    # Advisory file locks on a cache that several runs share, one lock per item that is being fetched into it.
+    # The items are spread over a fixed number of lock files by a hash of their name, so the lock files don't
+    # pile up; two items that share a lock file just wait for each other.
+    #
+    # Without fcntl (Windows) there is no locking, parallel runs then may fetch an item twice, but the atomic writes
+    # of the store still never leave a broken file behind.
+    stripes = 256
+
+    def __init__(self, directory, poll=0.2):
+        self.directory = directory
+        self.poll = poll
+        makedirs(directory, exist_ok=True)
+
+    def lock_path(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).digest()
+        return path.join(self.directory, '{:02x}.lock'.format(digest[0] % CacheLocks.stripes))
+
+    def try_acquire(self, name):
+        # The open lock file if the lock was free, None if another run (or another item of this run) holds it.
+        fd = open_fd(self.lock_path(name), O_RDWR | O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            close(fd)
+            return None
+        return fd
+
+    def hold(self, name):
+        # async with locks.hold(name): ...
+        return HeldLock(self, name)
+
+
+class HeldLock:
+    # The async context manager of CacheLocks.hold, a class as contextlib.asynccontextmanager needs Python 3.7.
+    # asyncio is imported only here, so the commands that don't crawl don't load it.
+    def __init__(self, locks, name):
+        self.locks = locks
+        self.name = name
+        self.fd = None
+
+    async def __aenter__(self):
+        if not has_locking():
+            return
+        import asyncio
+
+        # polled, so waiting never blocks the event loop
+        fd = self.locks.try_acquire(self.name)
+        while fd is None:
+            await asyncio.sleep(self.locks.poll)
+            fd = self.locks.try_acquire(self.name)
+        self.fd = fd
+
+    async def __aexit__(self, *exc_info):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            close(self.fd)
+            self.fd = None
@@ -0,0 +1,234 @@
+from urllib.parse import quote
+
+import lxml.html
+from lxml.cssselect import CSSSelector
+from lxml.etree import Comment
+
+from wanianki.record import ItemRecord
+from wanianki.svg import prepared_radical_image
+
+# lxml port of Exporter.extract: same selectors and the same record, but parsed by libxml2 and with every selector
+# compiled once per process. Output has to be identical to the BeautifulSoup path, which is the reference.
+# Use Exporter.verify_parser('lxml') after changing anything here.
+
+pf = '.container .row .span12 '
+
+# bs4 writes these as <tag/> and never gives them content.
+void_elements = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+    'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'
+}
+
+# bs4 treats these attributes as whitespace separated lists.
+list_attributes = {'class', 'rel', 'rev', 'accept-charset', 'headers', 'accesskey', 'dropzone'}
+
+selectors = {}
+
+
+def select(el, selector):
+    compiled = selectors.get(selector)
+    if compiled is None:
+        compiled = selectors[selector] = CSSSelector(selector)
+    return compiled(el)
+
+
+def select_one(el, selector):
+    found = select(el, selector)
+    return found[0] if found else None
+
+
+def text(node):
+    if isinstance(node, str):
+        return node
+    return node.text_content()
+
+
+def contents(el):
+    # Child nodes like bs4's Tag.contents: text runs and elements in document order.
+    nodes = []
+    if el.text:
+        nodes.append(el.text)
+    for child in el:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+    return nodes
+
+
+def classes(el):
+    return el.get('class', '').split()
+
+
+def escape(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def quote_attribute(value):
+    value = escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def decode(el):
+    if el.tag is Comment:
+        return '<!--' + (el.text or '') + '-->'
+
+    attributes = []
+    for key, value in sorted(el.attrib.items()):
+        if key in list_attributes:
+            value = ' '.join(value.split())
+        attributes.append(' ' + key + '=' + quote_attribute(value or ''))
+
+    if el.tag in void_elements:
+        return '<' + el.tag + ''.join(attributes) + '/>'
+    return '<' + el.tag + ''.join(attributes) + '>' + decode_contents(el) + '</' + el.tag + '>'
+
+
+def decode_contents(el):
+    parts = [escape(el.text or '')]
+    for child in el:
+        parts.append(decode(child))
+        parts.append(escape(child.tail or ''))
+    return ''.join(parts)
+
+
+def extract(store, item_type, url, html):
+    page = lxml.html.document_fromstring(html)
+    link = 'https://www.wanikani.com/' + url[1:]
+
+    if item_type == 'radical':
+        icon_type = 'radical'
+    elif item_type == 'kanji':
+        icon_type = 'kanji'
+    elif item_type == 'vocab':
+        icon_type = 'vocabulary'
+    else:
+        raise ValueError()
+
+    sections = select(page, pf + 'section')
+    h1 = select_one(page, pf + 'header h1')
+
+    level = int(text(select_one(page, pf + 'header h1 a.level-icon')))
+
+    radical_slug = ''
+    radical_image = ''
+    if item_type == 'radical':
+        radical_slug = link[len('https://www.wanikani.com/radicals/'):]
+        if store.has_radical_image(radical_slug):
+            radical_image, subject = prepared_radical_image(store, radical_slug)
+        else:
+            subject = text(select_one(page, pf + 'header h1 .' + icon_type + '-icon'))
+    else:
+        subject = text(select_one(page, pf + 'header h1 .' + icon_type + '-icon'))
+
+    primary_meaning = contents(h1)[-1].strip()
+    additional_meanings = ''
+    if item_type == 'kanji' or item_type == 'vocab':
+        additional_meanings = text(contents(select_one(page, pf + 'section#information .alternative-meaning'))[-2])
+
+    part_of_speech = ''
+    primary_reading = ''
+    additional_readings = ''
+    if item_type == 'vocab':
+        part_of_speech = text(select_one(page, pf + 'section#information .part-of-speech p'))
+        readings = text(select_one(page, pf + '.vocabulary-reading p')).strip().split(', ')
+        primary_reading = readings[0]
+        additional_readings = ', '.join(readings[1:])
+
+    on_reading = ''
+    kun_reading = ''
+    nanori_reading = ''
+    on_muted = False
+    kun_muted = False
+    nanori_muted = False
+
+    if item_type == 'kanji':
+        blocks = select(sections[3], '.span4')
+
+        def reading_block(block):
+            reading = text(select_one(block, 'p')).strip()
+            return '' if reading == 'None' else reading, 'muted-content' in classes(block)
+
+        on_reading, on_muted = reading_block(blocks[0])
+        kun_reading, kun_muted = reading_block(blocks[1])
+        nanori_reading, nanori_muted = reading_block(blocks[2])
+
+    def filter_mnemonic(el):
+        def filter_spans(raw_el):
+            for span in select(raw_el, 'span'):
+                span.attrib.pop('title', None)
+                span.attrib.pop('rel', None)
+
+        mnemonic_parts = []
+        for p in el:
+            if p.tag == 'p':
+                filter_spans(p)
+                mnemonic_parts.append(decode_contents(p))
+
+        hint_aside = select_one(el, 'aside')
+        if hint_aside is not None:
+            hint_parts = []
+            for hint in select(hint_aside, 'p'):
+                filter_spans(hint)
+                hint_parts.append(decode_contents(hint))
+            hint = '<br>\n<br>\n'.join(hint_parts)
+            mnemonic_parts.append('Hints:<br>\n' + hint)
+
+        return '<br>\n<br>\n'.join(mnemonic_parts)
+
+    meaning = filter_mnemonic(sections[2 if item_type == 'radical' else 4])
+    reading = ''
+    if item_type == 'kanji' or item_type == 'vocab':
+        reading = filter_mnemonic(sections[6])
+
+    context_sentences = ''
+    if item_type == 'vocab':
+        sentences = []
+        for group in select(page, pf + 'section.context-sentence .context-sentence-group'):
+            sentences.append('<br>\n'.join([text(i).strip() for i in select(group, 'p')]))
+
+        context_sentences = '<br>\n<br>\n'.join(sentences)
+
+    audio_path = ''
+    audio_url = ''
+    if item_type == 'vocab':
+        audio_path = 'wanikani_vocab_audio_' + quote(subject) + '.mp3'
+        audio_url = select_one(page, '.vocabulary-reading audio source[type="audio/mpeg"]').attrib['src']
+
+    if item_type == 'radical':
+        text_item_type = 'Radical'
+    elif item_type == 'kanji':
+        text_item_type = 'Kanji'
+    else:
+        text_item_type = 'Vocabulary'
+
+    if not subject:
+        raise Exception(('Missing subject', item_type, meaning, reading))
+
+    return ItemRecord(
+        subject=subject,
+        level=level,
+        item_type=text_item_type,
+        part_of_speech=part_of_speech,
+        primary_meaning=primary_meaning,
+        additional_meanings=additional_meanings,
+        primary_reading=primary_reading,
+        additional_readings=additional_readings,
+        on_reading=on_reading,
+        on_muted=on_muted,
+        kun_reading=kun_reading,
+        kun_muted=kun_muted,
+        nanori_reading=nanori_reading,
+        nanori_muted=nanori_muted,
+        meaning=meaning,
+        reading=reading,
+        context_sentences=context_sentences,
+        audio_path=audio_path,
+        audio_url=audio_url,
+        radical_slug=radical_slug,
+        radical_image=radical_image,
+        link=link
+    )
@@ -0,0 +1,285 @@
+import bisect
+import json
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from glob import glob
+from os import getpid, path, remove
+from tempfile import mkdtemp
+from time import perf_counter, time
+
+# Instrumentation of the crawl and the export: latency histograms, counters (bytes, retries, 429s) and the progress
+# of every stage. Off by default, every call returns right away until enable() is called. Enabled from main.py with
+# --metrics FILE (a json report at the end) and --live-metrics (a summary line instead of the plain progress).
+#
+# The extraction processes keep their own metrics and write them to a spool directory when they exit,
+# collect_workers() merges those into the parent's.
+
+# upper bounds of the histogram buckets, in milliseconds
+bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket the percentile falls in, the largest sample for the last bucket.
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bounds[i], self.max) if i < len(bounds) else self.max
+        return self.max
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else None,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'buckets': self.counts,
+        }
+
+    def merge(self, data):
+        self.counts = [a + b for a, b in zip(self.counts, data['buckets'])]
+        self.count += data['count']
+        self.total += data['total_ms']
+        if data['min_ms'] is not None:
+            self.min = data['min_ms'] if self.min is None else min(self.min, data['min_ms'])
+            self.max = data['max_ms'] if self.max is None else max(self.max, data['max_ms'])
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.live = False
+        self.output = None
+        # cProfile output directory for the extraction workers, None to not profile
+        self.profile_dir = None
+        self.spool = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time()
+        self.histograms = {}
+        self.counters = {}
+        # stage -> {'total', 'done', 'started', 'updated'}
+        self.stages = {}
+        self.last_live = 0
+
+    def enable(self, output=None, live=False, profile_dir=None):
+        self.enabled = True
+        self.output = output
+        self.live = live
+        self.profile_dir = profile_dir
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds * 1000)
+
+    def add(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def time(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def progress(self, stage, done, total):
+        # Called by dump_progress. Returns the live summary line, None to print the plain counter instead,
+        # or '' to print nothing: the summary is redrawn at most 5 times a second.
+        if not self.enabled:
+            return None
+
+        now = time()
+        state = self.stages.get(stage)
+        if state is None or done < state['done']:
+            state = self.stages[stage] = {'total': total, 'done': 0, 'started': now, 'updated': now}
+        state['total'] = total
+        state['done'] = done
+        state['updated'] = now
+
+        if not self.live:
+            return None
+        if now - self.last_live < 0.2 and done < total:
+            return ''
+        self.last_live = now
+        return self.summary(stage)
+
+    def stage_json(self, state):
+        seconds = state['updated'] - state['started']
+        rate = state['done'] / seconds if seconds > 0 else None
+        remaining = state['total'] - state['done']
+        return {
+            'total': state['total'],
+            'done': state['done'],
+            'seconds': seconds,
+            'per_second': rate,
+            'eta_seconds': remaining / rate if rate else None,
+        }
+
+    def summary(self, stage):
+        state = self.stage_json(self.stages[stage])
+        parts = ['[{}] {}/{}'.format(stage, state['done'], state['total'])]
+        if state['per_second']:
+            parts.append('{:.1f}/s'.format(state['per_second']))
+        if state['eta_seconds'] is not None:
+            parts.append('eta {:.0f}s'.format(state['eta_seconds']))
+
+        with self.lock:
+            for name in sorted(self.histograms):
+                if name.startswith('request.'):
+                    histogram = self.histograms[name]
+                    parts.append('{} p50 {:.0f}ms p95 {:.0f}ms'.format(
+                        name[len('request.'):], histogram.percentile(0.5), histogram.percentile(0.95)))
+            limiter = sum(h.total for name, h in self.histograms.items() if name.startswith('limiter.'))
+            retries = sum(value for name, value in self.counters.items() if name.startswith('retries.'))
+            received = sum(value for name, value in self.counters.items() if name.startswith('bytes.'))
+
+        parts.append('limiter {:.1f}s'.format(limiter / 1000))
+        parts.append('retries {}'.format(retries))
+        parts.append('{:.1f} MB'.format(received / 1024 / 1024))
+        return ' | '.join(parts)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'seconds': time() - self.started,
+                'stages': {stage: self.stage_json(state) for stage, state in self.stages.items()},
+                'histograms': {name: histogram.to_json() for name, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def merge(self, data):
+        with self.lock:
+            for name, histogram in data['histograms'].items():
+                self.histograms.setdefault(name, Histogram()).merge(histogram)
+            for name, value in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def write(self, output=None):
+        output = output or self.output
+        if not self.enabled or not output:
+            return
+        self.collect_workers()
+        with open(output, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    @contextmanager
+    def profile(self, name):
+        # cProfile the block into <profile dir>/<name>.prof, for extraction that runs in this process.
+        if not self.profile_dir:
+            yield
+            return
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            write_profile(profile, path.join(self.profile_dir, name + '.prof'))
+
+    def worker_setup(self):
+        # Arguments for init_worker in the extraction processes.
+        if not self.enabled:
+            return None, None
+        if self.spool is None:
+            self.spool = mkdtemp(prefix='wanianki-metrics-')
+        return self.spool, self.profile_dir
+
+    def collect_workers(self):
+        # Merge what the extraction processes wrote when they exited.
+        if self.spool is None:
+            return
+        for filename in glob(path.join(self.spool, 'worker-*.json')):
+            with open(filename) as f:
+                self.merge(json.load(f))
+            remove(filename)
+
+
+metrics = Metrics()
+
+
+def init_worker(spool, profile_dir):
+    # Runs in every extraction process. Its metrics and profile are written when the process exits,
+    # which requires the pool to be closed and joined, not terminated.
+    from multiprocessing.util import Finalize
+
+    # a forked worker starts with a copy of the parent's numbers
+    metrics.reset()
+    if spool:
+        metrics.enabled = True
+        metrics.live = False
+        Finalize(None, write_worker_metrics, (spool,), exitpriority=10)
+
+    if profile_dir:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        Finalize(None, write_profile, (profile, path.join(profile_dir, 'extraction-{}.prof'.format(getpid()))),
+                 exitpriority=10)
+
+
+def write_worker_metrics(spool):
+    with open(path.join(spool, 'worker-{}.json'.format(getpid())), 'w') as f:
+        json.dump(metrics.snapshot(), f)
+
+
+def write_profile(profile, filename):
+    profile.disable()
+    profile.dump_stats(filename)
+
+
+def timed(name):
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe(name, perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def instrument_io(cls):
+    # Class decorator for the stores: times every has_/load_/store_/get_ method as store.<method>.
+    for name, fn in list(vars(cls).items()):
+        if callable(fn) and name.startswith(('has_', 'load_', 'store_', 'get_')) and not name.endswith('_path'):
+            setattr(cls, name, timed('store.' + name)(fn))
+    return cls
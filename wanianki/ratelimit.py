@@ -0,0 +1,75 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+from time import time
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    # Token bucket shared by all requests to one host. Only used from the event loop thread.
+    def __init__(self, rate, capacity=1, min_rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time()
+        self.blocked_until = 0
+        self.sleeping = 0
+        self.lock = asyncio.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # Waiters queue up on the lock, so tokens are handed out in request order.
+        async with self.lock:
+            while True:
+                now = time()
+                if now < self.blocked_until:
+                    await self.sleep(self.blocked_until - now)
+                    continue
+
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await self.sleep((1 - self.tokens) / self.rate)
+
+    async def sleep(self, seconds):
+        self.sleeping += seconds
+        await asyncio.sleep(seconds)
+
+    def backoff(self, retry_after=None):
+        # Multiplicative decrease, and stop handing out tokens until the server allows it again.
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self.updated = time()
+        delay = retry_after if retry_after is not None else 1 / self.rate
+        self.blocked_until = max(self.blocked_until, time() + delay)
+
+    def recover(self):
+        # Additive increase back to the configured rate after successful requests.
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,62 @@
+import struct
+
+# What the extraction returns for one page, in the order of the fields in the ANKI file (after the sort field),
+# followed by what the export needs besides the fields.
+fields = ('subject', 'level', 'item_type', 'primary_meaning', 'additional_meanings', 'part_of_speech',
+          'primary_reading', 'additional_readings', 'on_reading', 'kun_reading', 'nanori_reading', 'meaning',
+          'reading', 'context_sentences', 'audio_path', 'link')
+extra_fields = ('on_muted', 'kun_muted', 'nanori_muted', 'audio_url', 'radical_slug', 'radical_image')
+
+flag_fields = ('on_muted', 'kun_muted', 'nanori_muted')
+text_fields = tuple(name for name in fields + extra_fields if name != 'level' and name not in flag_fields)
+
+# level and the flags, then the utf-8 length of every text field
+header = struct.Struct('<HB{}I'.format(len(text_fields)))
+
+
+class ItemRecord:
+    # Extracted item with a fixed set of slots, ~9000 of them are held during an export.
+    #
+    # to_bytes is the compact form the extraction cache stores and the pool sends back: a fixed size header and
+    # the utf-8 text fields back to back, no field names. Pickling uses the same form.
+    __slots__ = fields + extra_fields
+
+    def __init__(self, **values):
+        for name in ItemRecord.__slots__:
+            setattr(self, name, values.pop(name))
+        if values:
+            raise TypeError(('Unknown record fields', sorted(values)))
+
+    def __eq__(self, other):
+        return isinstance(other, ItemRecord) and self.differences(other) == []
+
+    def differences(self, other):
+        # names of the fields that differ, for comparing parsers
+        return [name for name in ItemRecord.__slots__ if getattr(self, name) != getattr(other, name)]
+
+    def to_bytes(self):
+        texts = [getattr(self, name).encode('utf-8') for name in text_fields]
+        flags = self.on_muted | self.kun_muted << 1 | self.nanori_muted << 2
+        return header.pack(self.level, flags, *map(len, texts)) + b''.join(texts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        level, flags, *lengths = header.unpack_from(data)
+        record = cls.__new__(cls)
+        record.level = level
+        record.on_muted = bool(flags & 1)
+        record.kun_muted = bool(flags & 2)
+        record.nanori_muted = bool(flags & 4)
+
+        offset = header.size
+        for name, length in zip(text_fields, lengths):
+            setattr(record, name, data[offset:offset + length].decode('utf-8'))
+            offset += length
+        return record
+
+    def __reduce__(self):
+        return ItemRecord.from_bytes, (self.to_bytes(),)
+
+    def __repr__(self):
+        return 'ItemRecord({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                                  for name in ItemRecord.__slots__))
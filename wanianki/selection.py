@@ -0,0 +1,81 @@
+from urllib.parse import unquote
+
+# item type as used by the importer/exporter -> (type in the api, name of the lattice list)
+item_types = {
+    'radical': ('radical', 'radicals'),
+    'kanji': ('kanji', 'kanji'),
+    'vocab': ('vocabulary', 'vocabulary'),
+}
+
+
+class Selection:
+    # Restricts a crawl and export to some levels and item types. None means everything.
+    def __init__(self, levels=None, types=None):
+        self.levels = sorted(set(levels)) if levels else None
+        self.types = [t for t in item_types if t in types] if types else None
+
+        if types:
+            unknown = set(types) - set(item_types)
+            if unknown:
+                raise ValueError(('Unknown item types', sorted(unknown)))
+
+    @classmethod
+    def parse(cls, levels=None, types=None):
+        # levels like '1-10' or '1,3,5-7', types like 'kanji,vocab'
+        parsed_levels = None
+        if levels:
+            parsed_levels = []
+            for part in levels.split(','):
+                if '-' in part:
+                    first, last = part.split('-')
+                    first, last = int(first), int(last)
+                    # like 10-1, selecting no level would mean selecting all of them
+                    if first > last:
+                        raise ValueError(('Empty level range', part))
+                else:
+                    first = last = int(part)
+                if first < 1:
+                    raise ValueError(('Levels start at 1', part))
+                parsed_levels.extend(range(first, last + 1))
+
+        parsed_types = [t.strip() for t in types.split(',')] if types else None
+        return cls(parsed_levels, parsed_types)
+
+    def is_all(self):
+        return self.levels is None and self.types is None
+
+    def has_type(self, item_type):
+        return self.types is None or item_type in self.types
+
+    def matches(self, api_type, level):
+        if self.levels is not None and level not in self.levels:
+            return False
+        return self.types is None or api_type in [item_types[t][0] for t in self.types]
+
+    def api_filters(self):
+        filters = {}
+        if self.levels is not None:
+            filters['levels'] = ','.join(str(level) for level in self.levels)
+        if self.types is not None:
+            filters['types'] = ','.join(item_types[t][0] for t in self.types)
+        return filters
+
+    def covers(self, other):
+        # True if everything `other` selects is also selected by this selection.
+        if self.levels is not None and (other.levels is None or not set(other.levels) <= set(self.levels)):
+            return False
+        if self.types is not None and (other.types is None or not set(other.types) <= set(self.types)):
+            return False
+        return True
+
+    def to_json(self):
+        return {'levels': self.levels, 'types': self.types}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['levels'], data['types']) if data else cls()
+
+    def filter_urls(self, urls, paths):
+        if self.is_all():
+            return urls
+        return [url for url in urls if unquote(url) in paths]
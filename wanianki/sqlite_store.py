@@ -0,0 +1,249 @@
+import json
+import sqlite3
+import zlib
+from os import getpid, listdir
+from time import time
+
+from wanianki.store import Store
+from wanianki.metrics import instrument_io
+from wanianki.record import ItemRecord
+
+
+@instrument_io
+class SqliteStore(Store):
+    # Same surface as Store, but pages, svgs, json documents and extracted records live in one SQLite database,
+    # zlib compressed. Audio and the csv stay files, Anki needs those on disk.
+    #
+    # Writes are batched: they are committed every `batch_size` writes or `batch_seconds`, and on flush().
+    # A crash loses at most the uncommitted batch, never leaves a half written page. Whatever has to wait for the
+    # batch, like marking a crawl job done in the ledger, goes through when_committed.
+    #
+    # The database belongs to one account, a cache shared by several accounts needs the file store.
+    def __init__(self, directory='imported/', batch_size=200, batch_seconds=5.0):
+        super().__init__(directory)
+        self.database = self.dir('store.sqlite')
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.connection = None
+        self.pending = 0
+        self.last_commit = time()
+        # called after the next commit
+        self.committed = []
+
+        self.connect().executescript('''
+            CREATE TABLE IF NOT EXISTS json (name TEXT PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS radical_svgs (slug TEXT PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS extractions (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS subjects (
+                id INTEGER PRIMARY KEY, object TEXT NOT NULL, level INTEGER NOT NULL, data BLOB NOT NULL);
+            CREATE INDEX IF NOT EXISTS subjects_object_level ON subjects (object, level);
+        ''')
+
+    # The store is pickled into the extraction pool, every process opens its own connection.
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['committed'] = []
+        return state
+
+    # A forked pool worker inherits the parent's connection instead of unpickling the store, it must not use it.
+    def after_fork(self):
+        if self.connection is not None and self.connection_pid != getpid():
+            self.connection = None
+            self.pending = 0
+            self.committed = []
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.database, timeout=60, check_same_thread=False)
+            self.connection_pid = getpid()
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        return self.connection
+
+    def flush(self):
+        if self.connection is not None and self.pending:
+            self.connection.commit()
+        self.pending = 0
+        self.last_commit = time()
+
+        committed, self.committed = self.committed, []
+        for fn in committed:
+            fn()
+
+    def when_committed(self, fn):
+        if self.pending:
+            self.committed.append(fn)
+        else:
+            fn()
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def has(self, table, column, key):
+        row = self.connect().execute(
+            'SELECT 1 FROM {} WHERE {} = ?'.format(table, column), (key,)).fetchone()
+        return row is not None
+
+    def load(self, table, column, key):
+        return self.load_bytes(table, column, key).decode('utf-8')
+
+    def load_bytes(self, table, column, key):
+        row = self.connect().execute(
+            'SELECT data FROM {} WHERE {} = ?'.format(table, column), (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError((table, key))
+        return zlib.decompress(row[0])
+
+    def store(self, table, column, key, content, commit=False):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.connect().execute(
+            'INSERT OR REPLACE INTO {} ({}, data) VALUES (?, ?)'.format(table, column),
+            (key, zlib.compress(content)))
+        self.pending += 1
+        if commit or self.pending >= self.batch_size or time() - self.last_commit > self.batch_seconds:
+            self.flush()
+
+    def store_json(self, filepath, data):
+        self.store('json', 'name', filepath, json.dumps(data), commit=True)
+
+    def load_json(self, filepath):
+        return json.loads(self.load('json', 'name', filepath))
+
+    def has_json(self, filepath):
+        return self.has('json', 'name', filepath)
+
+    def remove_json(self, filepath):
+        self.connect().execute('DELETE FROM json WHERE name = ?', (filepath,))
+        self.pending += 1
+        self.flush()
+
+    def has_all_subjects(self):
+        if self.has_json('subjects_meta'):
+            return True
+        if self.has_json('all_subjects.json'):
+            self.migrate_all_subjects()
+            return True
+        return False
+
+    def subjects_writer(self, append=False):
+        return SqliteSubjectsWriter(self, append)
+
+    def iter_subjects(self, object_type=None, levels=None):
+        query = 'SELECT data FROM subjects'
+        conditions = []
+        parameters = []
+        if object_type is not None:
+            conditions.append('object = ?')
+            parameters.append(object_type)
+        if levels is not None:
+            conditions.append('level IN ({})'.format(','.join('?' * len(levels))))
+            parameters.extend(levels)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        # a cursor of its own, the rows are fetched as they are consumed
+        for row in self.connect().cursor().execute(query + ' ORDER BY id', parameters):
+            yield json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def subjects_updated_at(self):
+        return self.load_json('subjects_meta')['updated_at']
+
+    def count_subjects(self):
+        return dict(self.connect().execute('SELECT object, COUNT(*) FROM subjects GROUP BY object').fetchall())
+
+    def has_page(self, url):
+        return self.has('pages', 'url', url)
+
+    def store_page(self, page, url):
+        self.store('pages', 'url', url, page)
+
+    def load_page(self, url):
+        return self.load('pages', 'url', url)
+
+    def has_radical_image(self, slug):
+        return self.has('radical_svgs', 'slug', slug)
+
+    def store_radical_image(self, content, slug):
+        self.store('radical_svgs', 'slug', slug, content)
+
+    def load_radical_image(self, slug):
+        return self.load('radical_svgs', 'slug', slug)
+
+    def has_extraction(self, key):
+        return self.has('extractions', 'key', key)
+
+    def store_extraction(self, record, key):
+        # Committed right away, pool workers are never flushed.
+        self.store('extractions', 'key', key, record.to_bytes(), commit=True)
+
+    def load_extraction(self, key):
+        return ItemRecord.from_bytes(self.load_bytes('extractions', 'key', key))
+
+    def copy_from(self, store):
+        # One-off migration from the file based Store, so switching backends doesn't mean crawling again.
+        if store.has_all_subjects() and not self.has_all_subjects():
+            with self.subjects_writer() as writer:
+                for subject in store.iter_subjects():
+                    writer.add(subject)
+                writer.updated_at = store.subjects_updated_at()
+
+        for name in ('radicals_list.json', 'kanji_list.json', 'vocabulary_list.json',
+                     'audio_list.json', 'sync_manifest.json'):
+            if store.has_json(name) and not self.has_json(name):
+                self.store_json(name, store.load_json(name))
+
+        for name in ('radicals', 'kanji', 'vocabulary'):
+            if not store.has_lattice_list(name):
+                continue
+            for url in store.get_lattice_list(name):
+                if store.has_page(url[1:]) and not self.has_page(url[1:]):
+                    self.store_page(store.load_page(url[1:]), url[1:])
+
+        for filename in listdir(store.shared_dir('radical_svgs')):
+            slug = filename[:-len('.svg')]
+            if filename.endswith('.svg') and not self.has_radical_image(slug):
+                self.store_radical_image(store.load_radical_image(slug), slug)
+
+        self.flush()
+
+
+class SqliteSubjectsWriter:
+    # SubjectsWriter for the database: the subjects go into the subjects table in one transaction.
+    def __init__(self, store, append=False):
+        self.store = store
+        self.updated_at = store.subjects_updated_at() if append and store.has_all_subjects() else None
+
+        # commit what's batched, so an error only rolls back the subjects
+        store.flush()
+        if not append:
+            store.connect().execute('DELETE FROM subjects')
+
+    def add(self, subject):
+        self.store.connect().execute(
+            'INSERT OR REPLACE INTO subjects (id, object, level, data) VALUES (?, ?, ?, ?)',
+            (subject['id'], subject['object'], subject['data']['level'],
+             zlib.compress(json.dumps(subject, separators=(',', ':')).encode('utf-8'))))
+
+    def add_collection(self, collection):
+        for subject in collection['data']:
+            self.add(subject)
+        updated_at = collection.get('data_updated_at')
+        if updated_at and (self.updated_at is None or updated_at > self.updated_at):
+            self.updated_at = updated_at
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.store.connect().rollback()
+            self.store.pending = 0
+            return
+        self.store.store_json('subjects_meta', {'updated_at': self.updated_at})
@@ -0,0 +1,47 @@
+from datetime import datetime
+from os import path
+
+from wanianki.ledger import JobLedger
+from wanianki.selection import item_types
+
+
+def status(store, failed_shown=5):
+    # How much of the crawl is in the store and what is missing, from the store's own indexes: the subjects
+    # index, the page and audio lists and the job ledger. Nothing is parsed and nothing touches the network.
+    if not store.has_all_subjects():
+        print('[subjects] not synced yet, run: main.py crawl')
+        return
+
+    counts = store.count_subjects()
+    print('[subjects] {} cached, updated at {}'.format(sum(counts.values()), store.subjects_updated_at()))
+
+    for item_type, (api_type, name) in item_types.items():
+        line = '[{}] {} subjects'.format(item_type, counts.get(api_type, 0))
+        if store.has_lattice_list(name):
+            urls = store.get_lattice_list(name)
+            stored = sum(1 for url in urls if store.has_page(url[1:]))
+            line += ', {}/{} pages'.format(stored, len(urls))
+        else:
+            line += ', no page list yet'
+        print(line)
+
+    if store.has_audio_list():
+        audios = store.load_audio_list()
+        stored = sum(1 for subject, mp3src in audios if store.has_audio(subject))
+        print('[audio] {}/{} mp3s'.format(stored, len(audios)))
+
+    ledger = JobLedger(store.dir('jobs.log'))
+    for stage, states in sorted(ledger.summary().items()):
+        print('[jobs] {}: {}'.format(stage, ', '.join(
+            '{} {}'.format(count, state) for state, count in sorted(states.items(), key=lambda i: str(i[0])))))
+    failed = [entry for entry in ledger.jobs.values() if entry['state'] == JobLedger.failed]
+    for entry in failed[:failed_shown]:
+        print('[failed] {} {} after {} attempts: {}'.format(
+            entry['stage'], entry['job'], entry['attempts'], entry.get('error')))
+    if len(failed) > failed_shown:
+        print('[failed] and {} more'.format(len(failed) - failed_shown))
+
+    for output_path in (store.get_output_path(), store.get_package_path()):
+        if path.isfile(output_path):
+            written = datetime.fromtimestamp(path.getmtime(output_path)).isoformat(' ', 'seconds')
+            print('[export] {} written {}'.format(output_path, written))
@@ -0,0 +1,295 @@
+import json
+from os import path, makedirs, remove, replace
+from tempfile import mkstemp
+
+from wanianki.metrics import instrument_io
+from wanianki.record import ItemRecord
+from wanianki.svg import media_name
+
+
+@instrument_io
+class Store:
+    # The state of one account lives in `directory`: the subjects cache, the page and audio lists, the sync manifest,
+    # the job ledger and the outputs. Pages, svgs, mp3s and extracted records are the same for every account, they
+    # live in `shared` if given, a cache that several accounts (and parallel runs) use, so each is fetched once.
+    # Extracted records and prepared svgs are keyed by a hash of their content, the rest by url, slug or name.
+    def __init__(self, directory='imported/', shared=None):
+        self.directory = path.join(directory, '')
+        self.shared = path.join(shared, '') if shared else self.directory
+        # held while an item is fetched into the shared cache, see Importer.claimed
+        self.locks = None
+        if shared:
+            from wanianki.locks import CacheLocks
+            self.locks = CacheLocks(self.shared_dir('locks'))
+
+        makedirs(self.directory, exist_ok=True)
+        makedirs(self.shared_dir('pages'), exist_ok=True)
+        makedirs(self.shared_dir('radical_svgs'), exist_ok=True)
+        makedirs(self.shared_dir('media'), exist_ok=True)
+        makedirs(self.shared_dir('audio'), exist_ok=True)
+        makedirs(self.shared_dir('extracted'), exist_ok=True)
+
+    def dir(self, subdir):
+        return self.directory + subdir
+
+    def shared_dir(self, subdir):
+        return self.shared + subdir
+
+    def isfile(self, filepath):
+        return path.isfile(filepath)
+
+    def write(self, filepath, content):
+        # Written next to the final path and renamed into place: a crash never leaves a truncated file behind,
+        # so a file that exists is complete.
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        fd, temporary = mkstemp(dir=path.dirname(filepath), prefix=path.basename(filepath) + '.', suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(content)
+            replace(temporary, filepath)
+        except BaseException:
+            remove(temporary)
+            raise
+
+    def store_json(self, filepath, data):
+        self.write(self.dir(filepath), json.dumps(data, indent=2))
+
+    def load_json(self, filepath):
+        with open(self.dir(filepath), 'r') as f:
+            return json.load(f)
+
+    def has_json(self, filepath):
+        return self.isfile(self.dir(filepath))
+
+    def remove_json(self, filepath):
+        remove(self.dir(filepath))
+
+    def flush(self):
+        # Writes go straight to disk, nothing is buffered.
+        pass
+
+    def when_committed(self, fn):
+        # Calls fn once everything written so far is durable, right away here.
+        fn()
+
+    def after_fork(self):
+        # Called in every extraction worker, nothing is tied to the process here.
+        pass
+
+    # The /subjects cache: one compact json record per line in subjects.ndjson, a later line for the same id replaces
+    # an earlier one. subjects_index.json maps every id to the offset of its current line, its type and level,
+    # so subjects of a type and level are streamed without loading the whole cache.
+    def has_all_subjects(self):
+        if self.isfile(self.dir('subjects.ndjson')):
+            return True
+        if self.has_json('all_subjects.json'):
+            self.migrate_all_subjects()
+            return True
+        return False
+
+    def migrate_all_subjects(self):
+        # all_subjects.json was the list of /subjects pages as they came from the api
+        with self.subjects_writer() as writer:
+            for collection in self.load_json('all_subjects.json'):
+                writer.add_collection(collection)
+        self.remove_json('all_subjects.json')
+
+    def subjects_writer(self, append=False):
+        return SubjectsWriter(self, append)
+
+    def iter_subjects(self, object_type=None, levels=None):
+        index = self.load_subjects_index()
+        wanted = [offset for offset, subject_type, level in index['subjects'].values()
+                  if (object_type is None or subject_type == object_type) and (levels is None or level in levels)]
+
+        # only the wanted lines are read, in file order, replaced lines and other types and levels are skipped
+        with open(self.dir('subjects.ndjson'), 'rb') as f:
+            for offset in sorted(wanted):
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def subjects_updated_at(self):
+        return self.load_subjects_index()['updated_at']
+
+    def count_subjects(self):
+        # object type -> number of cached subjects, from the index alone
+        counts = {}
+        for offset, object_type, level in self.load_subjects_index()['subjects'].values():
+            counts[object_type] = counts.get(object_type, 0) + 1
+        return counts
+
+    def load_subjects_index(self):
+        filepath = self.dir('subjects.ndjson')
+        index = self.load_json('subjects_index.json') if self.has_json('subjects_index.json') else None
+        if index is None or index['size'] != path.getsize(filepath):
+            index = self.rebuild_subjects_index(index['updated_at'] if index else None)
+        return index
+
+    def rebuild_subjects_index(self, updated_at=None):
+        # After a crash between appending subjects and writing the index. A cut off last line is dropped.
+        filepath = self.dir('subjects.ndjson')
+        index = {'size': 0, 'lines': 0, 'updated_at': updated_at, 'subjects': {}}
+        with open(filepath, 'rb+') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    f.truncate(offset)
+                    break
+                subject = json.loads(line)
+                index['subjects'][str(subject['id'])] = [offset, subject['object'], subject['data']['level']]
+                index['lines'] += 1
+                offset += len(line)
+        index['size'] = offset
+        self.store_json('subjects_index.json', index)
+        return index
+
+    def compact_subjects(self):
+        updated_at = self.subjects_updated_at()
+        with self.subjects_writer() as writer:
+            for subject in self.iter_subjects():
+                writer.add(subject)
+            writer.updated_at = updated_at
+
+    def store_lattice_list(self, name, urls):
+        self.store_json(name + '_list.json', urls)
+
+    def get_lattice_list(self, name):
+        return self.load_json(name + '_list.json')
+
+    def has_lattice_list(self, name):
+        return self.has_json(name + '_list.json')
+
+    def has_page(self, url):
+        return self.isfile(self.shared_dir('pages/' + url.replace('/', '_')))
+
+    def store_page(self, page, url):
+        self.write(self.shared_dir('pages/' + url.replace('/', '_')), page)
+
+    def load_page(self, url):
+        with open(self.shared_dir('pages/' + url.replace('/', '_')), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def has_radical_image(self, slug):
+        return self.isfile(self.shared_dir('radical_svgs/' + slug + '.svg'))
+
+    def store_radical_image(self, content, slug):
+        self.write(self.shared_dir('radical_svgs/' + slug + '.svg'), content)
+
+    def load_radical_image(self, slug):
+        with open(self.shared_dir('radical_svgs/' + slug + '.svg'), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    # Prepared radical svgs (see wanianki.svg), keyed by a hash of the original. They stay files with every store,
+    # they are the svg media files of the export.
+    def has_prepared_svg(self, digest):
+        return self.isfile(self.get_prepared_svg_path(digest))
+
+    def store_prepared_svg(self, content, digest):
+        self.write(self.get_prepared_svg_path(digest), content)
+
+    def load_prepared_svg(self, digest):
+        with open(self.get_prepared_svg_path(digest), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def get_prepared_svg_path(self, digest):
+        return self.shared_dir('media/' + media_name(digest))
+
+    # Extracted records, keyed by a hash of everything the record is extracted from (see Exporter.extraction_key).
+    # A changed page or svg gets a new key, so stale records are never returned.
+    def has_extraction(self, key):
+        return self.isfile(self.shared_dir('extracted/' + key + '.record'))
+
+    def store_extraction(self, record, key):
+        self.write(self.shared_dir('extracted/' + key + '.record'), record.to_bytes())
+
+    def load_extraction(self, key):
+        with open(self.shared_dir('extracted/' + key + '.record'), 'rb') as f:
+            return ItemRecord.from_bytes(f.read())
+
+    def store_audio_list(self, audios):
+        self.store_json('audio_list.json', audios)
+
+    def load_audio_list(self):
+        return self.load_json('audio_list.json')
+
+    def has_audio_list(self):
+        return self.has_json('audio_list.json')
+
+    def has_audio(self, name):
+        return self.isfile(self.shared_dir('audio/' + name + '.mp3'))
+
+    def get_audio_path(self, name):
+        return self.shared_dir('audio/' + name + '.mp3')
+
+    def has_sync_manifest(self):
+        return self.has_json('sync_manifest.json')
+
+    def store_sync_manifest(self, manifest):
+        self.store_json('sync_manifest.json', manifest)
+
+    def load_sync_manifest(self):
+        if not self.has_sync_manifest():
+            return {'subjects_updated_at': None, 'validators': {}}
+        return self.load_json('sync_manifest.json')
+
+    def get_output_path(self):
+        return self.dir('wanikani_export.csv')
+
+    def get_package_path(self):
+        return self.dir('wanikani.apkg')
+
+
+class SubjectsWriter:
+    # Adds subjects to the cache as the pages of /subjects arrive. A new cache is written next to the current one
+    # and replaces it when the writer is closed without an error. Appended subjects replace earlier ones.
+    def __init__(self, store, append=False):
+        self.store = store
+        self.append = append
+        self.target = store.dir('subjects.ndjson')
+        self.updated_at = None
+
+        if append:
+            self.index = store.load_subjects_index()
+            self.filepath = self.target
+            self.file = open(self.target, 'ab')
+            self.offset = self.file.tell()
+        else:
+            self.index = {'size': 0, 'lines': 0, 'updated_at': None, 'subjects': {}}
+            fd, self.filepath = mkstemp(dir=store.dir(''), prefix='subjects.', suffix='.tmp')
+            self.file = open(fd, 'wb')
+            self.offset = 0
+
+    def add(self, subject):
+        line = (json.dumps(subject, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        self.file.write(line)
+        self.index['subjects'][str(subject['id'])] = [self.offset, subject['object'], subject['data']['level']]
+        self.index['lines'] += 1
+        self.offset += len(line)
+
+    def add_collection(self, collection):
+        for subject in collection['data']:
+            self.add(subject)
+        updated_at = collection.get('data_updated_at')
+        if updated_at and (self.updated_at is None or updated_at > self.updated_at):
+            self.updated_at = updated_at
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is not None:
+            if not self.append:
+                remove(self.filepath)
+            return
+
+        if not self.append:
+            replace(self.filepath, self.target)
+        self.index['size'] = self.offset
+        if self.updated_at and (self.index['updated_at'] is None or self.updated_at > self.index['updated_at']):
+            self.index['updated_at'] = self.updated_at
+        self.store.store_json('subjects_index.json', self.index)
+
+        if self.index['lines'] > 2 * len(self.index['subjects']) + 1000:
+            self.store.compact_subjects()
@@ -0,0 +1,65 @@
+from urllib.parse import unquote, urlparse
+
+from wanianki.selection import item_types
+
+
+class SubjectIndex:
+    # Lookups over the subjects cache, built once per run: by document path, and per api type the subjects in level
+    # and lesson order. It replaces scraping the lattice pages for the lists of pages to crawl, the api has every
+    # subject's url.
+    #
+    # The subjects are streamed from the store and only the fields below are kept, not the whole api records.
+    def __init__(self, subjects):
+        self.by_path = {}
+        self.by_type = {api_type: [] for api_type, name in item_types.values()}
+
+        for subject in subjects:
+            data = subject['data']
+            if data.get('hidden_at'):
+                continue
+
+            images = [image['url'] for image in data.get('character_images') or ()
+                      if image['metadata'].get('inline_styles')]
+            entry = {
+                'id': subject['id'],
+                'object': subject['object'],
+                'level': data['level'],
+                'slug': data['slug'],
+                'lesson_position': data.get('lesson_position', 0),
+                'path': urlparse(data['document_url']).path,
+                'svg': images[0] if images else None,
+            }
+
+            self.by_path[unquote(entry['path'])] = entry
+            if entry['object'] in self.by_type:
+                self.by_type[entry['object']].append(entry)
+
+        for entries in self.by_type.values():
+            entries.sort(key=lambda e: (e['level'], e['lesson_position'], e['id']))
+
+    @classmethod
+    def from_store(cls, store, selection=None):
+        # With a selection, only the selected subjects are read from the cache.
+        if selection is None or selection.is_all():
+            return cls(store.iter_subjects())
+
+        def selected():
+            for item_type, (api_type, name) in item_types.items():
+                if selection.has_type(item_type):
+                    yield from store.iter_subjects(api_type, selection.levels)
+        return cls(selected())
+
+    def urls(self, api_type, previous=None):
+        # Page urls of all subjects of a type, as the list of pages to crawl. Urls already in `previous`
+        # keep their spelling there, it's the key of the stored page.
+        spelling = {unquote(url): url for url in previous or ()}
+        return [spelling.get(unquote(entry['path']), entry['path']) for entry in self.by_type[api_type]]
+
+    def paths(self, selection):
+        # Unquoted document paths (like /kanji/一) of the selected subjects.
+        return set(path for path, entry in self.by_path.items() if selection.matches(entry['object'], entry['level']))
+
+    def image_radicals(self, selection):
+        # (slug, url of the svg with inline styles) of the selected radicals
+        return [(entry['slug'], entry['svg']) for entry in self.by_type['radical']
+                if entry['svg'] and selection.matches('radical', entry['level'])]
@@ -0,0 +1,66 @@
+import hashlib
+import re
+
+# Radical svgs as they come from WaniKani carry an xml prolog, editor comments and metadata, and are indented.
+# They are prepared once per distinct svg: stripped, minified and sized to the surrounding text, and cached in the
+# store under a hash of the original, so an updated svg is prepared again and identical svgs share one file.
+
+# Bump when prepare_svg changes its output, it invalidates the cache.
+prepare_version = 1
+
+sizing = 'width: 1em; height: 1em;'
+
+removed_blocks = re.compile(
+    r'<\?xml.*?\?>|<!DOCTYPE[^>]*>|<!--.*?-->|<metadata\b.*?</metadata>|<title\b.*?</title>|<desc\b.*?</desc>',
+    re.DOTALL | re.IGNORECASE)
+# editor leftovers on the root element, none of them change the rendering
+removed_attributes = re.compile(r'\s(?:version|x|y|xml:space|enable-background|data-name)="[^"]*"')
+root_tag = re.compile(r'<svg\b[^>]*>')
+
+
+def prepare_svg(content):
+    content = removed_blocks.sub('', content)
+    content = re.sub(r'>\s+<', '><', content.strip())
+
+    root = root_tag.search(content)
+    if root is None:
+        return content
+
+    tag = removed_attributes.sub('', root.group(0))
+    if 'xlink:' not in content[root.end():]:
+        tag = re.sub(r'\sxmlns:xlink="[^"]*"', '', tag)
+    tag = re.sub(r'\s+', ' ', tag)
+
+    style = re.search(r'\sstyle="([^"]*)"', tag)
+    if style:
+        tag = tag[:style.start(1)] + sizing + ' ' + style.group(1) + tag[style.end(1):]
+    else:
+        tag = tag[:-1].rstrip('/ ') + ' style="' + sizing + '"' + ('/>' if tag.endswith('/>') else '>')
+
+    return content[:root.start()] + tag + content[root.end():]
+
+
+def svg_digest(content):
+    return hashlib.sha1('{}\0{}'.format(prepare_version, content).encode('utf-8')).hexdigest()
+
+
+def media_name(digest):
+    return 'wanikani_radical_' + digest + '.svg'
+
+
+def prepared_radical_image(store, slug):
+    # (media file name, prepared svg) of a stored radical svg, prepared now if it isn't cached yet.
+    digest = svg_digest(store.load_radical_image(slug))
+    if store.has_prepared_svg(digest):
+        return media_name(digest), store.load_prepared_svg(digest)
+
+    prepared = prepare_svg(store.load_radical_image(slug))
+    store.store_prepared_svg(prepared, digest)
+    return media_name(digest), prepared
+
+
+def prepare_radical_images(store, slugs):
+    # The preprocessing stage after the svgs are downloaded, so the extraction only ever reads the cache.
+    for slug in slugs:
+        if store.has_radical_image(slug):
+            prepared_radical_image(store, slug)
@@ -0,0 +1,153 @@
+import json
+import re
+from os import path, remove, replace
+
+from wanianki.metrics import metrics
+from wanianki.ratelimit import RateLimited, parse_retry_after
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+# File downloads go to <path>.part first and are renamed into place once the size checks out,
+# so a file at the final path is always complete. A leftover .part is resumed with a Range request.
+def partial_path(filepath):
+    return filepath + '.part'
+
+
+def resume_offset(filepath):
+    partial = partial_path(filepath)
+    return path.getsize(partial) if path.isfile(partial) else 0
+
+
+def range_headers(offset):
+    return {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+
+def expected_size(status, headers, offset):
+    # Returns (append to the partial file, expected total size or None if unknown).
+    if status == 206:
+        match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', headers.get('Content-Range', ''))
+        if not match or int(match.group(1)) != offset:
+            raise IncompleteDownload(('Unexpected Content-Range', headers.get('Content-Range')))
+        return True, int(match.group(2)) if match.group(2) != '*' else None
+
+    if 200 <= status < 300:
+        length = headers.get('Content-Length')
+        if not length or headers.get('Content-Encoding', 'identity') != 'identity':
+            return False, None
+        return False, int(length)
+
+    raise IncompleteDownload(('HTTP status', status))
+
+
+def discard_partial(filepath):
+    partial = partial_path(filepath)
+    if path.isfile(partial):
+        remove(partial)
+
+
+def finish_download(filepath, total):
+    partial = partial_path(filepath)
+    size = path.getsize(partial)
+    if total is not None and size != total:
+        if size > total:
+            remove(partial)
+        raise IncompleteDownload(('Size mismatch', filepath, size, total))
+    replace(partial, filepath)
+
+
+# Page and svg requests carry the ETag/Last-Modified of the stored copy, a 304 means it is still current.
+def conditional_headers(validators):
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def response_validators(headers):
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    return validators
+
+
+def has_aiohttp():
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class AiohttpTransport:
+    # Native asyncio transport: no worker threads, every request is a coroutine on the importer's loop.
+    # Connections are capped per host by the connector of that host's session.
+    def __init__(self, headers_for, limit_per_host, timeout=(10, 60)):
+        import aiohttp
+        self.aiohttp = aiohttp
+
+        self.headers_for = headers_for
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.sessions = {}
+
+    def session_for(self, host, api):
+        if host not in self.sessions:
+            connector = self.aiohttp.TCPConnector(limit=self.limit_per_host)
+            self.sessions[host] = self.aiohttp.ClientSession(
+                connector=connector, headers=self.headers_for(api), timeout=self.timeout)
+        return self.sessions[host]
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+    @staticmethod
+    def check_rate_limited(response):
+        if response.status == 429 or (response.status >= 400 and 'Retry-After' in response.headers):
+            raise RateLimited(parse_retry_after(response.headers.get('Retry-After')))
+
+    async def get_json(self, host, url, params):
+        async with self.session_for(host, True).get(url, params=params) as response:
+            self.check_rate_limited(response)
+            body = await response.read()
+            metrics.add('bytes.api', len(body))
+            return json.loads(body.decode(response.get_encoding()))
+
+    async def get_text(self, host, url, validators=None):
+        async with self.session_for(host, False).get(url, headers=conditional_headers(validators)) as response:
+            self.check_rate_limited(response)
+            if response.status == 304:
+                return None, validators
+            if response.status >= 400:
+                raise Exception(('Page request failed', response.status, url))
+            body = await response.read()
+            metrics.add('bytes.site', len(body))
+            return body.decode(response.get_encoding()), response_validators(response.headers)
+
+    async def download(self, host, url, filepath):
+        offset = resume_offset(filepath)
+        try:
+            async with self.session_for(host, False).get(url, headers=range_headers(offset)) as response:
+                self.check_rate_limited(response)
+                if response.status == 416:
+                    discard_partial(filepath)
+                    raise IncompleteDownload(('Range not satisfiable', url))
+
+                append, total = expected_size(response.status, response.headers, offset)
+                with open(partial_path(filepath), 'ab' if append else 'wb') as f:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        f.write(chunk)
+                        metrics.add('bytes.file', len(chunk))
+        except self.aiohttp.ClientError as e:
+            raise IncompleteDownload((url, e))
+
+        finish_download(filepath, total)
@@ -0,0 +1,89 @@
+# The markup the extraction relies on, per item type, checked by Exporter.validate_pages on every stored page so a
+# change on WaniKani's side shows up as a list of broken selectors instead of an exception deep in an export.
+# Keep in line with the selectors of Exporter.extract and wanianki.lxml_extractor.
+#
+# A check is (name, selector, minimum number of matches, within): with `within` = (selector, index) the selector
+# is matched inside the index-th match of that selector, like the extraction does with the page's sections.
+# Only what the extraction can't do without is checked, a vocab without context sentences is fine.
+pf = '.container .row .span12 '
+sections = pf + 'section'
+
+header_checks = [
+    ('level icon', pf + 'header h1 a.level-icon', 1, None),
+    ('header', pf + 'header h1', 1, None),
+]
+
+checks = {
+    'radical': header_checks + [
+        ('radical icon', pf + 'header h1 .radical-icon', 1, None),
+        ('sections', sections, 3, None),
+        ('meaning mnemonic', 'p', 1, (sections, 2)),
+    ],
+    'kanji': header_checks + [
+        ('kanji icon', pf + 'header h1 .kanji-icon', 1, None),
+        ('alternative meaning', pf + 'section#information .alternative-meaning', 1, None),
+        ('sections', sections, 7, None),
+        ('reading blocks', '.span4', 3, (sections, 3)),
+        ('reading block texts', '.span4 p', 3, (sections, 3)),
+        ('meaning mnemonic', 'p', 1, (sections, 4)),
+        ('reading mnemonic', 'p', 1, (sections, 6)),
+    ],
+    'vocab': header_checks + [
+        ('vocabulary icon', pf + 'header h1 .vocabulary-icon', 1, None),
+        ('alternative meaning', pf + 'section#information .alternative-meaning', 1, None),
+        ('part of speech', pf + 'section#information .part-of-speech p', 1, None),
+        ('vocabulary reading', pf + '.vocabulary-reading p', 1, None),
+        ('sections', sections, 7, None),
+        ('meaning mnemonic', 'p', 1, (sections, 4)),
+        ('reading mnemonic', 'p', 1, (sections, 6)),
+        ('audio', '.vocabulary-reading audio source[type="audio/mpeg"]', 1, None),
+    ],
+}
+
+# reported instead of the checks for a listed page that isn't in the store
+page_missing = 'page missing'
+
+# the radical's characters aren't read from the page when its svg is stored
+svg_replaces = {'radical icon'}
+
+
+def describe(item_type, name):
+    # the selector of a check, for the report
+    if name == page_missing:
+        return 'a stored page, crawl again'
+    for check_name, selector, minimum, within in checks[item_type]:
+        if check_name == name:
+            if within:
+                return '{} {} within {}[{}]'.format(minimum, selector, within[0].strip(), within[1])
+            return '{} {}'.format(minimum, selector.strip())
+
+
+def broken_checks(html, item_type, parser='bs4', has_svg=False):
+    # names of the checks the page fails, parsed with the same parser as the export
+    if html is None:
+        return [page_missing]
+    if parser == 'lxml':
+        import lxml.html
+        from wanianki.lxml_extractor import select
+        page = lxml.html.document_fromstring(html)
+    else:
+        from bs4 import BeautifulSoup
+        page = BeautifulSoup(html, 'html.parser')
+
+        def select(el, selector):
+            return el.select(selector)
+
+    broken = []
+    for name, selector, minimum, within in checks[item_type]:
+        if has_svg and name in svg_replaces:
+            continue
+        scope = page
+        if within:
+            found = select(page, within[0])
+            if len(found) <= within[1]:
+                broken.append(name)
+                continue
+            scope = found[within[1]]
+        if len(select(scope, selector)) < minimum:
+            broken.append(name)
+    return broken